@@ -2,8 +2,10 @@
 import logging
 from datetime import datetime
 from typing import Dict, Any
+from sqlalchemy import bindparam, cast, func, text, update
+from sqlalchemy.dialects.postgresql import JSONB
 from database import db
-from models import CharacterEvolution
+from models import CharacterEvolution, CharacterEvolutionEvent
 
 logger = logging.getLogger(__name__)
 
@@ -25,18 +27,17 @@ def evolve_character_traits(char_evolution_id: int, story_context: str) -> bool:
             logger.error(f"[Evolve] Character evolution record {char_evolution_id} not found.")
             return False
 
-        # Ensure evolution_log is a list
-        if not isinstance(char_evolution.evolution_log, list):
-            char_evolution.evolution_log = []
-
-        # Append new interaction log
-        log_entry = {
-            "type": "story_interaction",
-            "context": story_context[:100] + "...",  # Truncate for preview
-            "timestamp": datetime.utcnow().isoformat()
-        }
-        char_evolution.evolution_log.append(log_entry)
-        logger.debug(f"[Evolve] Appended to evolution_log for CharacterEvolution {char_evolution_id}: {log_entry}")
+        # Record the interaction as an append-only child row instead of
+        # rewriting the evolution_log JSONB list
+        event = CharacterEvolutionEvent(
+            character_evolution_id=char_evolution.id,
+            kind='story_interaction',
+            payload={
+                "context": story_context[:100] + "..."  # Truncate for preview
+            }
+        )
+        db.session.add(event)
+        logger.debug(f"[Evolve] Recorded story_interaction event for CharacterEvolution {char_evolution_id}.")
 
         # Update timestamp
         char_evolution.last_updated = datetime.utcnow()
@@ -77,37 +78,65 @@ def update_character_relationships(
         char_map = {str(ce.character_id): ce for ce in char_evolutions}
         logger.debug(f"[Relationships] Found {len(char_map)} character evolution records for user {user_id}, story {story_id}.")
 
-        # Helper to update both sides of the relationship
-        def _update_relationship(from_ce, to_id, rel_type, strength):
-            from_ce.add_relationship(
-                target_character_id=to_id,
-                relationship_type=rel_type,
-                strength=strength
-            )
-            logger.debug(f"[Relationships] Updated {from_ce.character_id} -> {to_id} with type '{rel_type}' and strength {strength}.")
+        # Look up the protagonist once rather than per change entry
+        protag_ce = char_map.get(str(protagonist_id))
+        now_iso = datetime.utcnow().isoformat()
+
+        # Accumulate one relationship_network patch per row so the whole
+        # batch can be flushed in a single UPDATE instead of 2N round-trips
+        patches: Dict[int, Dict[str, Any]] = {}
 
-        # Update relationships
+        def _queue_relationship(from_ce, to_id, rel_type, strength):
+            patches.setdefault(from_ce.id, {})[str(to_id)] = {
+                "type": rel_type,
+                "strength": strength,
+                "last_updated": now_iso
+            }
+            logger.debug(f"[Relationships] Queued {from_ce.character_id} -> {to_id} with type '{rel_type}' and strength {strength}.")
+
+        # Collect relationship updates
         for target_id, change_data in relationship_changes.items():
             if target_id not in char_map:
                 logger.warning(f"[Relationships] Target character {target_id} not found in evolution records.")
                 continue
 
             target_ce = char_map[target_id]
-            
+
             # Get relationship details
             rel_type = change_data.get('type', 'neutral')
             strength = change_data.get('amount', 0)
-            
+
             # Update relationship from protagonist to target
-            if str(protagonist_id) in char_map:
-                protag_ce = char_map[str(protagonist_id)]
-                _update_relationship(protag_ce, target_id, rel_type, strength)
-            
+            if protag_ce:
+                _queue_relationship(protag_ce, target_id, rel_type, strength)
+
             # Update relationship from target to protagonist (may be different)
             inverse_strength = change_data.get('inverse_amount', strength)
             inverse_type = change_data.get('inverse_type', rel_type)
-            _update_relationship(target_ce, protagonist_id, inverse_type, inverse_strength)
-            
+            _queue_relationship(target_ce, protagonist_id, inverse_type, inverse_strength)
+
+        if patches:
+            # One prepared UPDATE executed for the whole batch — psycopg2
+            # pipelines the parameter sets as a single executemany
+            stmt = (
+                update(CharacterEvolution)
+                .where(CharacterEvolution.id == bindparam('ce_id'))
+                .values(
+                    relationship_network=func.coalesce(
+                        CharacterEvolution.relationship_network,
+                        text("'{}'::jsonb")
+                    ).op('||')(cast(bindparam('patch'), JSONB)),
+                    last_updated=func.now()
+                )
+            )
+            # Through the session's connection, not the session: ORM-level
+            # execute treats an entity UPDATE plus a parameter list as
+            # bulk-update-by-primary-key and rejects the ce_id bindparam
+            db.session.connection().execute(
+                stmt,
+                [{'ce_id': ce_id, 'patch': patch} for ce_id, patch in patches.items()]
+            )
+
         db.session.commit()
         logger.info(f"[Relationships] Successfully updated relationships for user {user_id}, story {story_id}.")
         return True
@@ -0,0 +1,40 @@
+
+from datetime import datetime
+from .base import db
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+class Transaction(db.Model):
+    """Model for recording individual currency transactions"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.String(255), nullable=False, index=True)
+    transaction_type = db.Column(db.String(64))  # choice, mission_reward, level_up, etc.
+    from_currency = db.Column(db.String(8))  # Currency spent
+    to_currency = db.Column(db.String(8))  # Currency received
+    amount = db.Column(db.BigInteger)
+    description = db.Column(db.Text)
+    story_node_id = db.Column(db.Integer, db.ForeignKey('story_node.id', ondelete='SET NULL'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class UserCurrency(db.Model):
+    """Model for denormalized per-currency balances
+
+    Balance increments used to mutate UserProgress.currency_balances (JSONB),
+    which rewrites and re-TOASTs the whole document on every reward. A narrow
+    row per (user, currency) turns the hot increment into one small UPSERT.
+    """
+    user_id = db.Column(db.String(255), primary_key=True)
+    currency = db.Column(db.String(8), primary_key=True)
+    amount = db.Column(db.BigInteger, nullable=False, default=0)
+
+    @classmethod
+    def credit(cls, user_id, currency, amount):
+        """Atomically add (or subtract) an amount for one currency"""
+        stmt = pg_insert(cls.__table__).values(
+            user_id=user_id,
+            currency=currency,
+            amount=amount
+        ).on_conflict_do_update(
+            index_elements=['user_id', 'currency'],
+            set_={'amount': cls.__table__.c.amount + amount}
+        )
+        db.session.execute(stmt)
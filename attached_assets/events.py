@@ -0,0 +1,29 @@
+
+from datetime import datetime
+from .base import db
+from sqlalchemy.dialects.postgresql import JSONB
+
+class MissionEvent(db.Model):
+    """Model for append-only mission progress events
+
+    Progress updates used to be appended to Mission.progress_updates (a
+    JSONB list), rewriting the whole column for every entry. The log is only
+    ever appended to and read chronologically, so each event is a child row
+    and recording one is a plain O(1) insert.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    mission_id = db.Column(db.Integer, db.ForeignKey('mission.id', ondelete='CASCADE'),
+                           nullable=False, index=True)
+    ts = db.Column(db.DateTime, default=datetime.utcnow)
+    kind = db.Column(db.String(32))  # progress, completed, failed, etc.
+    payload = db.Column(JSONB, default=dict)
+
+class CharacterEvolutionEvent(db.Model):
+    """Model for append-only character evolution events (see MissionEvent)"""
+    id = db.Column(db.Integer, primary_key=True)
+    character_evolution_id = db.Column(db.Integer,
+                                       db.ForeignKey('character_evolution.id', ondelete='CASCADE'),
+                                       nullable=False, index=True)
+    ts = db.Column(db.DateTime, default=datetime.utcnow)
+    kind = db.Column(db.String(32))  # story_interaction, trait_added, etc.
+    payload = db.Column(JSONB, default=dict)
@@ -2,9 +2,12 @@
 import logging
 import re
 from datetime import datetime
+from types import SimpleNamespace
 from typing import Dict, List, Optional, Any, Tuple
 
-from models import ImageAnalysis, Mission, UserProgress, StoryGeneration
+from sqlalchemy import event, func, insert, or_, text, update
+
+from models import ImageAnalysis, Mission, MissionEvent, UserProgress, StoryGeneration
 from database import db
 
 logger = logging.getLogger(__name__)
@@ -25,6 +28,78 @@ BASE_REWARDS = {
     '💴': 150000  # Yen
 }
 
+# Precompiled mission-extraction patterns (compiling per call is pure
+# overhead). Kept as four separate scans: a fused alternation is
+# non-overlapping, and the target normally sits inside the objective
+# clause, so one pattern's match would swallow another's span.
+_GIVER_RE = re.compile(r'figure of (\w+ Corp|[A-Z][a-z]+)')
+_TARGET_RE = re.compile(r"on (\w+\'s) plans|against (\w+)")
+_OBJECTIVE_RE = re.compile(r'mission—(.+?)[\.\']')
+_REWARD_RE = re.compile(r'reward\?\s*(\d{1,3}(?:,\d{3})*|\d+)\s*([💎💵💷💶💴])')
+
+# Cache of lowercased name fragment -> ImageAnalysis id. Shared by the
+# single and batched lookups so both stay warm. Only positive hits are
+# cached — a miss must stay a live query so a character image added later
+# is still found — and only ids (never ORM objects, which would leak
+# sessions). Bounded with oldest-first eviction; invalidated by the
+# after_insert listener below.
+_character_id_cache: Dict[str, int] = {}
+_CHARACTER_ID_CACHE_MAX = 4096
+
+
+def clear_character_id_cache() -> None:
+    """Flush the name->id cache so new character images become findable"""
+    _character_id_cache.clear()
+
+
+@event.listens_for(ImageAnalysis, 'after_insert')
+def _invalidate_character_id_cache(mapper, connection, target):
+    if target.image_type == 'character':
+        clear_character_id_cache()
+
+
+def _find_character_id_by_name(name_lower: str) -> Optional[int]:
+    """Resolve a single character name fragment to an ImageAnalysis id."""
+    return _find_character_ids_by_names([name_lower])[name_lower]
+
+
+def _find_character_ids_by_names(names_lower: List[str]) -> Dict[str, Optional[int]]:
+    """
+    Resolve several character name fragments in one round-trip.
+
+    Uncached fragments are OR-ed into a single query and results are
+    bucketed back to their fragments by substring match in Python.
+
+    The filter is written as lower(character_name) LIKE so it matches the
+    partial pg_trgm GIN index on lower(character_name) WHERE
+    image_type = 'character' — a bare ILIKE '%...%' cannot use it.
+    """
+    results = {name: _character_id_cache[name] for name in names_lower
+               if name in _character_id_cache}
+    missing = [name for name in names_lower if name not in results]
+
+    if missing:
+        rows = ImageAnalysis.query.with_entities(
+            ImageAnalysis.id, ImageAnalysis.character_name
+        ).filter(
+            ImageAnalysis.image_type == 'character',
+            or_(*[func.lower(ImageAnalysis.character_name).like(f"%{name}%")
+                  for name in missing])
+        ).all()
+
+        for name in missing:
+            match = next((row.id for row in rows
+                          if name in (row.character_name or '').lower()), None)
+            results[name] = match
+            if match is not None:
+                if len(_character_id_cache) >= _CHARACTER_ID_CACHE_MAX:
+                    # Oldest entry sits at the front of the dict
+                    _character_id_cache.pop(next(iter(_character_id_cache)))
+                _character_id_cache[name] = match
+
+    return results
+
+
 def extract_mission_details(story_text: str) -> Optional[Dict[str, Any]]:
     """
     Extract mission giver, target, objective, and reward from a story.
@@ -36,20 +111,18 @@ def extract_mission_details(story_text: str) -> Optional[Dict[str, Any]]:
         Optional[Dict[str, Any]]: Dictionary with extracted mission details or None if extraction failed
     """
     try:
-        # Example regex patterns (can be expanded/adjusted based on story format)
-        giver_match = re.search(r'figure of (\w+ Corp|[A-Z][a-z]+)', story_text) 
-        target_match = re.search(r'on (\w+\'s) plans|against (\w+)', story_text)
-        objective_match = re.search(r'mission—(.+?)[\.\']', story_text)
-        reward_match = re.search(r'reward\?\s*(\d{1,3}(?:,\d{3})*|\d+)\s*([💎💵💷💶💴])', story_text)
+        giver_match = _GIVER_RE.search(story_text)
+        target_match = _TARGET_RE.search(story_text)
+        objective_match = _OBJECTIVE_RE.search(story_text)
+        reward_match = _REWARD_RE.search(story_text)
 
         giver = giver_match.group(1) if giver_match else None
-        target = target_match.group(1) if target_match and target_match.group(1) else \
-                target_match.group(2) if target_match else None
+        target = (target_match.group(1) or target_match.group(2)) if target_match else None
         objective = objective_match.group(1).strip() if objective_match else "Objective not clearly specified."
-        
+
         # Clean target (if 'Ekaterina's', remove "'s")
-        if target and "'s" in target:
-            target = target.replace("'s", "")
+        if target:
+            target = target.removesuffix("'s")
 
         # Parse reward
         reward_amount = int(reward_match.group(1).replace(",", "")) if reward_match else 1500
@@ -70,17 +143,22 @@ def extract_mission_details(story_text: str) -> Optional[Dict[str, Any]]:
         return None
 
 
-def create_mission_from_story(user_id: str, story_text: str, story_id: Optional[int] = None) -> Optional[Mission]:
+def create_mission_from_story(user_id: str, story_text: str, story_id: Optional[int] = None,
+                              user_progress: Optional[UserProgress] = None) -> Optional[SimpleNamespace]:
     """
     Take story text, extract mission details, and create a mission.
-    
+
     Args:
         user_id (str): ID of the user
         story_text (str): Text of the story containing mission details
         story_id (Optional[int]): ID of the related story
-        
+        user_progress (Optional[UserProgress]): Already-loaded progress row,
+            to avoid re-fetching it at every step of the mission flow
+
     Returns:
-        Optional[Mission]: Created Mission object or None if creation failed
+        Optional[SimpleNamespace]: Lightweight record of the created mission
+            (same fields plus id, no ORM instrumentation) or None if
+            creation failed
     """
     details = extract_mission_details(story_text)
     if not details:
@@ -88,25 +166,17 @@ def create_mission_from_story(user_id: str, story_text: str, story_id: Optional[
         return None
 
     try:
-        # Fetch giver/target from DB based on extracted names (example logic)
-        giver = None
-        target = None
-        
-        if details['giver']:
-            giver = ImageAnalysis.query.filter(
-                ImageAnalysis.image_type == 'character',
-                ImageAnalysis.character_name.ilike(f"%{details['giver']}%")
-            ).first()
-            
-        if details['target']:
-            target = ImageAnalysis.query.filter(
-                ImageAnalysis.image_type == 'character', 
-                ImageAnalysis.character_name.ilike(f"%{details['target']}%")
-            ).first()
+        # Fetch giver/target from DB in one combined round-trip
+        giver_id = None
+        target_id = None
 
-        # Fall back to None if not found
-        giver_id = giver.id if giver else None
-        target_id = target.id if target else None
+        names = [details[key].lower() for key in ('giver', 'target') if details[key]]
+        if names:
+            ids_by_name = _find_character_ids_by_names(names)
+            if details['giver']:
+                giver_id = ids_by_name[details['giver'].lower()]
+            if details['target']:
+                target_id = ids_by_name[details['target'].lower()]
 
         # Auto-assign difficulty based on reward amount
         difficulty = "easy"
@@ -126,8 +196,9 @@ def create_mission_from_story(user_id: str, story_text: str, story_id: Optional[
         # Create deadline text
         deadline = f"Complete within {3 if difficulty == 'hard' else 5} days"
 
-        # Create mission
-        mission = Mission(
+        # Create mission via Core insert — skips ORM unit-of-work
+        # bookkeeping for one plain row; RETURNING provides the id
+        mission_values = dict(
             user_id=user_id,
             title=title,
             description=description,
@@ -140,20 +211,24 @@ def create_mission_from_story(user_id: str, story_text: str, story_id: Optional[
             deadline=deadline,
             story_id=story_id
         )
-        
-        db.session.add(mission)
-        db.session.commit()
-        
-        # Add to user's active missions
-        user_progress = UserProgress.query.filter_by(user_id=user_id).first()
+        mission_id = db.session.execute(
+            insert(Mission).values(**mission_values).returning(Mission.id)
+        ).scalar_one()
+        mission = SimpleNamespace(id=mission_id, **mission_values)
+
+        # Add to user's active missions (reuse the caller's row if provided)
+        if user_progress is None:
+            user_progress = UserProgress.query.filter_by(user_id=user_id).first()
         if user_progress:
             if not user_progress.active_missions:
-                user_progress.active_missions = []
-            
-            if mission.id not in user_progress.active_missions:
-                user_progress.active_missions.append(mission.id)
-                db.session.commit()
-        
+                user_progress.active_missions = {}
+
+            user_progress.active_missions.setdefault(str(mission.id), 1)
+
+        # One commit covers both the insert (RETURNING already supplied the
+        # id) and the progress update
+        db.session.commit()
+
         logger.info(f"Created mission from story for user {user_id}: {mission.title}")
         return mission
         
@@ -163,31 +238,36 @@ def create_mission_from_story(user_id: str, story_text: str, story_id: Optional[
         return None
 
 
-def generate_mission(user_id: str, story_id: Optional[int] = None) -> Optional[Mission]:
+def generate_mission(user_id: str, story_id: Optional[int] = None,
+                     user_progress: Optional[UserProgress] = None) -> Optional[Mission]:
     """
     Generate a new mission for the user based on story content if available
-    
+
     Args:
         user_id (str): ID of the user
         story_id (Optional[int]): ID of a specific story to use
-        
+        user_progress (Optional[UserProgress]): Already-loaded progress row,
+            fetched once by the route handler and passed down
+
     Returns:
         Optional[Mission]: Created Mission object or None if creation failed
     """
     try:
-        # If story_id is provided, try to extract mission from that story
+        # If story_id is provided, try to extract mission from that story.
+        # Only the two top-level keys we use are selected — PostgreSQL's
+        # JSONB accessors return just those sub-trees instead of the whole
+        # generated document
         if story_id:
-            story = StoryGeneration.query.get(story_id)
-            if story and story.generated_story:
-                # Try to parse the JSON story content
+            row = db.session.query(
+                StoryGeneration.generated_story['mission'],
+                StoryGeneration.generated_story['story']
+            ).filter_by(id=story_id).first()
+            if row is not None:
+                mission_data, story_text = row
                 try:
-                    import json
-                    story_data = json.loads(story.generated_story)
-                    
                     # If the story has a mission field, use that directly
-                    if 'mission' in story_data and story_data['mission'] and story_data['mission'].get('title'):
-                        mission_data = story_data['mission']
-                        
+                    if mission_data and mission_data.get('title'):
+
                         # Try to find target and giver characters
                         giver_id = None
                         target_id = None
@@ -197,24 +277,14 @@ def generate_mission(user_id: str, story_id: Optional[int] = None) -> Optional[M
                             giver_id = int(mission_data['giver_id'])
                         # Otherwise try to find by name
                         elif mission_data.get('giver'):
-                            giver = ImageAnalysis.query.filter(
-                                ImageAnalysis.image_type == 'character',
-                                ImageAnalysis.character_name.ilike(f"%{mission_data['giver']}%")
-                            ).first()
-                            if giver:
-                                giver_id = giver.id
+                            giver_id = _find_character_id_by_name(mission_data['giver'].lower())
                         
                         # If target_id is provided directly  
                         if mission_data.get('target_id') and mission_data.get('target_id').isdigit():
                             target_id = int(mission_data['target_id'])
                         # Otherwise try to find by name
                         elif mission_data.get('target'):
-                            target = ImageAnalysis.query.filter(
-                                ImageAnalysis.image_type == 'character',
-                                ImageAnalysis.character_name.ilike(f"%{mission_data['target']}%")
-                            ).first()
-                            if target:
-                                target_id = target.id
+                            target_id = _find_character_id_by_name(mission_data['target'].lower())
                                 
                         # Create the mission
                         mission = Mission(
@@ -232,34 +302,44 @@ def generate_mission(user_id: str, story_id: Optional[int] = None) -> Optional[M
                         )
                         
                         db.session.add(mission)
-                        db.session.commit()
-                        
-                        # Add to user's active missions
-                        user_progress = UserProgress.query.filter_by(user_id=user_id).first()
+                        # Flush (not commit) so PostgreSQL assigns the id
+                        # via RETURNING before the progress update
+                        db.session.flush()
+
+                        # Add to user's active missions (reuse the caller's row if provided)
+                        if user_progress is None:
+                            user_progress = UserProgress.query.filter_by(user_id=user_id).first()
                         if user_progress:
                             if not user_progress.active_missions:
-                                user_progress.active_missions = []
-                                
-                            if mission.id not in user_progress.active_missions:
-                                user_progress.active_missions.append(mission.id)
-                                db.session.commit()
-                        
+                                user_progress.active_missions = {}
+
+                            user_progress.active_missions.setdefault(str(mission.id), 1)
+
+                        # One commit for the mission and the progress update
+                        db.session.commit()
+
                         logger.info(f"Created mission from story JSON for user {user_id}: {mission.title}")
                         return mission
                     
                     # If no mission in the JSON, try to extract from story text
-                    if 'story' in story_data and story_data['story']:
-                        return create_mission_from_story(user_id, story_data['story'], story_id)
-                    
+                    if story_text:
+                        return create_mission_from_story(user_id, story_text, story_id,
+                                                         user_progress=user_progress)
+
                 except Exception as e:
                     logger.error(f"Error parsing story data: {str(e)}")
-                    # If JSON parsing fails, try to use the raw story text
-                    return create_mission_from_story(user_id, story.generated_story, story_id)
-            
+                    # Fall back to the raw stored document (legacy rows may
+                    # hold stringified JSON the accessors can't pick apart)
+                    story = StoryGeneration.query.get(story_id)
+                    if story and story.generated_story:
+                        return create_mission_from_story(user_id, story.generated_story, story_id,
+                                                         user_progress=user_progress)
+
         # If we didn't create a mission from story, fall back to getting a recent story
         recent_story = StoryGeneration.query.filter_by(user_id=user_id).order_by(StoryGeneration.created_at.desc()).first()
         if recent_story and recent_story.generated_story:
-            return create_mission_from_story(user_id, recent_story.generated_story, recent_story.id)
+            return create_mission_from_story(user_id, recent_story.generated_story, recent_story.id,
+                                             user_progress=user_progress)
             
         # If we still don't have a mission, log that we couldn't generate one
         logger.warning(f"Could not generate mission for user {user_id}")
@@ -290,7 +370,8 @@ def update_mission_progress(mission_id: int, progress: int, description: Optiona
     return mission.update_progress(progress, description)
 
 
-def complete_mission(mission_id: int, user_id: str) -> bool:
+def complete_mission(mission_id: int, user_id: str,
+                     user_progress: Optional[UserProgress] = None) -> bool:
     """Mark a mission as completed and award the reward"""
     mission = get_mission_by_id(mission_id)
     if not mission or mission.status != 'active':
@@ -301,46 +382,65 @@ def complete_mission(mission_id: int, user_id: str) -> bool:
     mission.completed_at = datetime.utcnow()
     mission.progress = 100
     
-    # Add progress update
-    if not mission.progress_updates:
-        mission.progress_updates = []
-    
-    mission.progress_updates.append({
-        "progress": 100,
-        "status": "completed",
-        "timestamp": datetime.utcnow().isoformat(),
-        "description": "Mission successfully completed!"
-    })
-    
-    # Award reward to user
-    user_progress = UserProgress.query.filter_by(user_id=user_id).first()
+    # Record the completion as an append-only child row instead of
+    # rewriting the progress_updates JSONB list
+    db.session.add(MissionEvent(
+        mission_id=mission.id,
+        kind='completed',
+        payload={
+            "progress": 100,
+            "status": "completed",
+            "description": "Mission successfully completed!"
+        }
+    ))
+
+
+    # Award reward to user (reuse the caller's row if provided)
+    if user_progress is None:
+        user_progress = UserProgress.query.filter_by(user_id=user_id).first()
     if user_progress:
-        # Move mission from active to completed list
-        if not user_progress.active_missions:
-            user_progress.active_missions = []
-        if not user_progress.completed_missions:
-            user_progress.completed_missions = []
-            
-        if mission.id in user_progress.active_missions:
-            user_progress.active_missions.remove(mission.id)
-            
-        user_progress.completed_missions.append(mission.id)
-        
-        # Add currency reward
-        if mission.reward_currency in user_progress.currency_balances:
-            user_progress.currency_balances[mission.reward_currency] += mission.reward_amount
-        else:
-            user_progress.currency_balances[mission.reward_currency] = mission.reward_amount
-            
-        # Add experience points (based on difficulty)
+        # XP reward based on difficulty
         xp_rewards = {
             'easy': 50,
             'medium': 100,
             'hard': 200
         }
         xp_reward = xp_rewards.get(mission.difficulty, 50)
-        user_progress.add_experience_points(xp_reward, f"Completed mission: {mission.title}")
-        
+        mission_key = str(mission.id)
+
+        # Fold the set moves and the XP grant into one server-side UPDATE —
+        # no read-modify-write of the JSONB documents and one round-trip
+        # instead of three
+        new_xp = db.session.execute(
+            update(UserProgress)
+            .where(UserProgress.id == user_progress.id)
+            .values(
+                active_missions=func.coalesce(
+                    UserProgress.active_missions, text("'{}'::jsonb")
+                ).op('-')(mission_key),
+                completed_missions=func.jsonb_set(
+                    func.coalesce(UserProgress.completed_missions, text("'{}'::jsonb")),
+                    '{%s}' % mission_key,
+                    text("'1'::jsonb")
+                ),
+                experience_points=UserProgress.experience_points + xp_reward
+            )
+            .returning(UserProgress.experience_points)
+        ).scalar_one()
+        db.session.expire(user_progress,
+                          ['active_missions', 'completed_missions', 'experience_points'])
+
+        # Add currency reward through add_currency, which updates the
+        # spendable JSONB balance and mirrors the credit into the
+        # denormalized UserCurrency row
+        user_progress.add_currency(
+            mission.reward_currency, mission.reward_amount,
+            'mission_reward', f"Reward for completing mission: {mission.title}")
+
+        # Level-up check against the XP total the UPDATE returned
+        user_progress.apply_level_for_xp(new_xp)
+
+
         # Improve relationship with mission giver
         if mission.giver_id:
             user_progress.change_character_relationship(
@@ -361,7 +461,8 @@ def complete_mission(mission_id: int, user_id: str) -> bool:
     return True
 
 
-def fail_mission(mission_id: int, user_id: str, reason: Optional[str] = None) -> bool:
+def fail_mission(mission_id: int, user_id: str, reason: Optional[str] = None,
+                 user_progress: Optional[UserProgress] = None) -> bool:
     """Mark a mission as failed"""
     mission = get_mission_by_id(mission_id)
     if not mission or mission.status != 'active':
@@ -370,33 +471,31 @@ def fail_mission(mission_id: int, user_id: str, reason: Optional[str] = None) ->
     # Update mission status
     mission.status = 'failed'
     
-    # Add progress update
-    if not mission.progress_updates:
-        mission.progress_updates = []
-    
-    update = {
-        "status": "failed",
-        "timestamp": datetime.utcnow().isoformat()
-    }
-    
+    # Record the failure as an append-only child row instead of
+    # rewriting the progress_updates JSONB list
+    payload = {"status": "failed"}
     if reason:
-        update["reason"] = reason
-        
-    mission.progress_updates.append(update)
-    
-    # Update user progress
-    user_progress = UserProgress.query.filter_by(user_id=user_id).first()
+        payload["reason"] = reason
+
+    db.session.add(MissionEvent(
+        mission_id=mission.id,
+        kind='failed',
+        payload=payload
+    ))
+
+
+    # Update user progress (reuse the caller's row if provided)
+    if user_progress is None:
+        user_progress = UserProgress.query.filter_by(user_id=user_id).first()
     if user_progress:
-        # Move mission from active to failed list
+        # Move mission from active to failed set
         if not user_progress.active_missions:
-            user_progress.active_missions = []
+            user_progress.active_missions = {}
         if not user_progress.failed_missions:
-            user_progress.failed_missions = []
-            
-        if mission.id in user_progress.active_missions:
-            user_progress.active_missions.remove(mission.id)
-            
-        user_progress.failed_missions.append(mission.id)
+            user_progress.failed_missions = {}
+
+        user_progress.active_missions.pop(str(mission.id), None)
+        user_progress.failed_missions[str(mission.id)] = 1
         
         # Worsen relationship with mission giver
         if mission.giver_id:
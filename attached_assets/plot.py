@@ -2,6 +2,7 @@
 from datetime import datetime
 from .base import db
 from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.mutable import MutableList
 
 class PlotArc(db.Model):
     """Model for tracking story plot arcs"""
@@ -14,14 +15,14 @@ class PlotArc(db.Model):
     # Plot arc status and progress
     status = db.Column(db.String(32), default='active')  # active, completed, failed
     completion_criteria = db.Column(JSONB)  # Criteria to complete this arc
-    progress_markers = db.Column(JSONB, default=[])  # Key points in the arc's progress
-    
+    progress_markers = db.Column(MutableList.as_mutable(JSONB), default=list)  # Key points in the arc's progress
+
     # Key nodes and choices in this arc
-    key_nodes = db.Column(JSONB, default=[])  # List of important node IDs in this arc
-    branching_choices = db.Column(JSONB, default=[])  # Important choice points
-    
+    key_nodes = db.Column(MutableList.as_mutable(JSONB), default=list)  # List of important node IDs in this arc
+    branching_choices = db.Column(MutableList.as_mutable(JSONB), default=list)  # Important choice points
+
     # Involved characters
-    primary_characters = db.Column(JSONB, default=[])  # Character IDs central to this arc
+    primary_characters = db.Column(MutableList.as_mutable(JSONB), default=list)  # Character IDs central to this arc
     
     # Rewards for completion
     rewards = db.Column(JSONB)  # Currency, items, achievements, etc.
@@ -10,8 +10,29 @@ story_images = db.Table('story_images',
 )
 
 class StoryGeneration(db.Model):
-    """Model for storing generated story segments and their choices"""
+    """Model for storing generated story segments and their choices
+
+    The table grows without bound and is only ever queried for recent rows,
+    so in production it is range-partitioned by created_at (monthly child
+    tables managed by pg_partman):
+
+        SELECT partman.create_parent('public.story_generation',
+                                     'created_at', 'native', 'monthly');
+
+    The BRIN index below keeps created_at scans cheap either way.
+    """
+
+    __table_args__ = (
+        # Serves the "most recent story for a user" lookup as a backward
+        # index scan + LIMIT 1 instead of a filter-then-sort
+        db.Index('ix_story_generation_user_created', 'user_id',
+                 db.text('created_at DESC')),
+        db.Index('ix_story_generation_created_brin', 'created_at',
+                 postgresql_using='brin'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.String(255))
     primary_conflict = db.Column(db.String(255))
     setting = db.Column(db.String(255))
     narrative_style = db.Column(db.String(255))
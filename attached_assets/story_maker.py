@@ -1,8 +1,14 @@
+import asyncio
+import hashlib
 import os
-import json
 import logging
-from typing import Dict, List, Tuple, Optional, Any
-from openai import OpenAI
+import weakref
+
+import orjson
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, List, Tuple, Optional, Any, Union
+from openai import AsyncOpenAI, RateLimitError
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -12,12 +18,54 @@ api_key = os.environ.get("OPENAI_API_KEY")
 if not api_key:
     logger.warning("OpenAI API key not found in environment variables")
 
-# Initialize OpenAI client
-client = OpenAI(api_key=api_key)
-
-# Default story options
+# OpenAI clients are async so concurrent generations overlap their network
+# and model time instead of serializing multi-second round-trips. One client
+# per event loop: httpx's async pool is bound to the loop it was created on,
+# and the sync wrappers below run a fresh loop per call, so a shared
+# module-level client would intermittently fail once a keep-alive connection
+# from a closed loop is reused. Within a loop (and so within a gather
+# batch) calls share one pool; closed loops drop out of the weak dict along
+# with their client.
+_aclients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncOpenAI]" = \
+    weakref.WeakKeyDictionary()
+
+
+def _aclient() -> AsyncOpenAI:
+    """The AsyncOpenAI client bound to the running event loop"""
+    loop = asyncio.get_running_loop()
+    client = _aclients.get(loop)
+    if client is None:
+        client = AsyncOpenAI(api_key=api_key)
+        _aclients[loop] = client
+    return client
+
+# Concurrency cap for batched generation, to stay inside OpenAI RPM/TPM limits
+MAX_CONCURRENT_GENERATIONS = 8
+
+# Retries for rate-limited calls, with exponential backoff
+_MAX_RETRIES = 5
+
+# Exact-match response cache for story openings, keyed by SHA-256 of the
+# assembled prompt. Only openings (no story_context/previous_choice) are
+# cached — continuations depend on per-player history. A repeat of the same
+# parameter combo skips the OpenAI round-trip entirely.
+_story_cache: Dict[str, Dict[str, Any]] = {}
+_STORY_CACHE_MAX = 512
+
+# Semantic cache for openings built from free-text custom fields, where
+# near-duplicate wording ("bioweapon heist" vs "steal a bioweapon") defeats
+# the exact-match cache. Entries pair an embedding of the resolved parameters
+# with the stored response; a new request reuses the nearest entry above the
+# similarity threshold.
+_semantic_cache: List[Tuple[List[float], Dict[str, Any]]] = []
+_SEMANTIC_CACHE_MAX = 256
+_SEMANTIC_SIMILARITY_THRESHOLD = 0.95
+_EMBEDDING_MODEL = "text-embedding-3-small"
+
+# Default story options. Tuples rather than lists so callers can't mutate
+# the shared mapping
 STORY_OPTIONS = {
-    "conflicts": [
+    "conflicts": (
         ("🤵", "Double agent exposed"),
         ("💼", "Corporate espionage"),
         ("🧪", "Bioweapon heist"),
@@ -26,8 +74,8 @@ STORY_OPTIONS = {
         ("🕵️", "Government overthrow"),
         ("🌌", "Space station takeover"),
         ("🧠", "Mind control experiment")
-    ],
-    "settings": [
+    ),
+    "settings": (
         ("🗼", "Paris Office"),
         ("🏝️", "Private Luxury Island"),
         ("🏙️", "Dubai Mega-Skyscraper"),
@@ -36,16 +84,16 @@ STORY_OPTIONS = {
         ("🏰", "Monaco Casino"),
         ("🏜️", "Sahara Desert Compound"),
         ("🌋", "Volcanic Lair")
-    ],
-    "narrative_styles": [
+    ),
+    "narrative_styles": (
         ("😎", "Gen Z Teenage Drama"),
         ("🔥", "Steamy romance novel"),
         ("🤪", "Absurdist comedy"),
         ("🎭", "Melodramatic soap opera"),
         ("🎬", "High-budget action movie"),
         ("🤵", "Classic Bond film")
-    ],
-    "moods": [
+    ),
+    "moods": (
         ("🍸", "Sexy and seductive"),
         ("💥", "Explosive and chaotic"),
         ("😂", "Ridiculously over-the-top"),
@@ -54,17 +102,35 @@ STORY_OPTIONS = {
         ("🥂", "Party-focused hedonism"),
         ("🔫", "Action-packed gunfights"),
         ("🕶️", "Cool and stylish")
-    ]
+    )
 }
 
+# Serialized once at import so the options endpoint doesn't re-walk and
+# re-serialize the same static mapping on every request
+STORY_OPTIONS_JSON = orjson.dumps(STORY_OPTIONS).decode()
+
+# Reverse lookup emoji -> label across all categories, O(1) instead of
+# scanning the option lists
+_EMOJI_TO_LABEL = {emoji: label for category in STORY_OPTIONS.values() for emoji, label in category}
+
 
 # --- Helper functions ---
 
-def get_story_options() -> Dict[str, List[Tuple[str, str]]]:
+def get_story_options() -> Dict[str, Tuple[Tuple[str, str], ...]]:
     """Return available story options for UI display"""
     return STORY_OPTIONS
 
 
+def get_story_options_json() -> str:
+    """Return the options pre-serialized for the HTTP layer"""
+    return STORY_OPTIONS_JSON
+
+
+def lookup_option_label(emoji: str) -> Optional[str]:
+    """Map an option emoji to its label, across all categories"""
+    return _EMOJI_TO_LABEL.get(emoji)
+
+
 def extract_field(data: Dict[str, Any], field: str, alt_field: Optional[str] = None, default: Any = None):
     """Extract a field from data with fallback to alternative field name and default value"""
     if not data:
@@ -97,32 +163,236 @@ def extract_character_role(character_data: Dict[str, Any]) -> str:
     return extract_field(character_data, 'role', 'character_role', 'neutral')
 
 
+@dataclass(slots=True, frozen=True)
+class Character:
+    """Normalized character record for prompt building
+
+    The extract_field fallback chains run once in from_raw; everything
+    downstream is plain attribute access instead of repeated double
+    dict.get() probes per character. Slots avoid a per-instance __dict__;
+    frozen plus tuple fields makes instances hashable, so they can key
+    caches directly.
+    """
+    name: str = 'Unnamed Character'
+    role: str = 'neutral'
+    traits: Tuple[str, ...] = ()
+    plot_lines: Tuple[str, ...] = ()
+    style: str = ''
+
+    @classmethod
+    def from_raw(cls, data: Dict[str, Any]) -> 'Character':
+        traits = extract_character_traits(data)
+        if isinstance(traits, str):
+            # Handle case where traits might be a string
+            traits = (traits,)
+        return cls(
+            name=extract_character_name(data),
+            role=extract_character_role(data),
+            traits=tuple(traits) if traits else (),
+            plot_lines=tuple(extract_plot_lines(data) or ()),
+            style=extract_character_style(data)
+        )
+
+
+def _as_character(data: Optional[Union[Dict[str, Any], 'Character']]) -> Optional['Character']:
+    """Normalize a raw character dict to Character; passes through None/Character
+
+    Empty dicts (the routes' default for character_info) mean "no
+    character" and normalize to None rather than a placeholder.
+    """
+    if isinstance(data, Character):
+        return data
+    if not data:
+        return None
+    return Character.from_raw(data)
+
+
 # --- Main story generation ---
 
-def generate_story(
+# Static blocks of the prompt, assembled once at import. Everything invariant
+# lives at the front of every request (as the system message) so OpenAI's
+# automatic prompt caching can reuse the shared prefix across calls; the
+# dynamic parameters follow in the user message.
+_UNIVERSE_PROMPT = (
+    "This is set in the high stakes sexy dramatic international world of business, espionage, luxury, and parties. "
+    "The world is mostly as we know it, but there is some future tech and many of the villains have powerful global properties. "
+    "The world is in a state of emergency, and you believe the only way to save it is to party hard, seduce as many people as possible, and have James Bond style adventures with crazy action scenes and gunfights, "
+    "involving more and more beautiful people and increasingly ridiculous scenarios and global settings.\n\n"
+    "All the characters are constantly betraying each other and seducing each other. The narrative should be told directly to the reader (using 'you'), be over-the-top, "
+    "with excessive action scenes, dramatic romantic encounters, and constant plot twists where allies become enemies and vice versa.\n\n"
+    "Each character has international connections and unique skills they use in increasingly absurd ways.\n\n"
+    "IMPORTANT: The story should begin with a mission giver character (any character with the 'mission-giver' role) giving the player a mission. This mission should be a central plot point. The mission giver should be different for different playthroughs. They reluctantly task you with missions targeting villains while reminding you not to screw up again. These missions offer currency rewards when completed."
+)
+
+_STORY_RULES = (
+    "Create an engaging story introduction that:\n"
+    "1. Features the reader as 'you' (second-person narrative) as the main story driver, in the narrative style named in the request\n"
+    "2. Introduces the selected character (if provided) into a complex international spy scenario\n"
+    "3. IMPORTANT: If plot lines are provided for the character, you MUST incorporate at least one into the story\n"
+    "4. Follows the new-character guidance given in the request\n"
+    "5. Includes betrayal, romantic flings, and over-the-top action sequences\n"
+    "6. Uses the character's traits to guide their behavior and dialogue\n"
+    "7. CRITICAL: The story MUST begin with a mission-giver character assigning a mission to the player with these components:\n"
+    "   - A clear objective (steal an item, sabotage a plan, investigate a location, etc.)\n"
+    "   - A specific target character who has the 'villain' role\n"
+    "   - A large reward in one of the game currencies (💵, 💷, 💶, 💴)\n"
+    "   - A deadline or sense of urgency\n"
+    "   - The mission should be central to the plot and referenced throughout the story\n"
+    "   - IMPORTANT: The mission giver should be different for different playthroughs. They reluctantly task you with missions targeting villains while reminding you not to screw up again.\n"
+
+    "9. Provides three meaningful choice options that MUST relate to the mission:\n"
+    "   - One 'mission-advancing' choice: Clear progress on the primary objective\n"
+    "   - One 'risky' choice: High risk/reward or possible mission failure\n"
+    "   - One 'alternative' choice: Indirect help, intel gathering, new allies, or a delay\n"
+    "   - Lead to different potential outcomes (each one should sound sexy and dangerous)\n"
+    "   - Stay true to the characters' established traits\n"
+    "   - Relate to at least one of the plot lines or missions \n"
+    "   - IMPORTANT: One choice must allude to maybe needing outside help and introduce a new character from the database \n"
+    "   - REQUIRED: Each choice must have a dollar (💵) cost starting at $500, with increased costs for choices that: involve powerful characters, have higher risk/reward, include exotic locations, or advanced technology\n"
+    "   - Avoid dead ends but escalate the ridiculousness with each choice\n"
+    "10. Include clear consequences for each choice that involve romantic encounters, betrayal, or absurd action scenarios\n"
+    "11. If player has an active mission, reference it and potentially provide progress updates\n"
+)
+
+# The response shape is enforced by the json_schema response format below;
+# the system prompt only needs the semantics the schema can't express
+_RESPONSE_GUIDANCE = (
+    "Choice costs are dollar (💵) amounts starting around $500, scaled up by the protagonist's level and "
+    "by risk, powerful characters, exotic locations, or advanced technology. "
+    "The mission reward should be large and paid in one of the game currencies (💵, 💷, 💶, 💴). "
+    "List every featured character name in 'characters', including new characters."
+)
+
+SYSTEM_PROMPT = f"{_UNIVERSE_PROMPT}\n\n{_STORY_RULES}\n{_RESPONSE_GUIDANCE}"
+
+# Strict structured-output schema for a story episode. Bounding the shape
+# keeps generations near their realistic ~1500 tokens instead of letting the
+# model ramble toward the cap, and replaces the old ~2KB format example in
+# the prompt.
+_STORY_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "story_episode",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "title": {"type": "string", "description": "Episode title"},
+                "story": {"type": "string", "description": "The story text with integrated mission assignment"},
+                "choices": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "text": {"type": "string"},
+                            "consequence": {"type": "string", "description": "Brief outcome hint"},
+                            "currency_requirements": {
+                                "type": "object",
+                                "properties": {"💵": {"type": "integer"}},
+                                "required": ["💵"],
+                                "additionalProperties": False
+                            },
+                            "mission_impact": {"type": "string", "description": "How this choice affects the mission"},
+                            "type": {"type": "string", "enum": ["mission-advancing", "risky", "alternative"]}
+                        },
+                        "required": ["text", "consequence", "currency_requirements", "mission_impact", "type"],
+                        "additionalProperties": False
+                    }
+                },
+                "mission": {
+                    "type": "object",
+                    "properties": {
+                        "title": {"type": "string"},
+                        "description": {"type": "string"},
+                        "giver": {"type": "string", "description": "Name of character who gave the mission"},
+                        "giver_id": {"type": "string"},
+                        "target": {"type": "string", "description": "Name of target character (villain)"},
+                        "target_id": {"type": "string"},
+                        "objective": {"type": "string", "description": "What the player must do"},
+                        "reward_currency": {"type": "string", "description": "Currency symbol"},
+                        "reward_amount": {"type": "integer"},
+                        "deadline": {"type": "string", "description": "Narrative deadline description"},
+                        "difficulty": {"type": "string", "enum": ["Easy", "Medium", "Hard"]}
+                    },
+                    "required": ["title", "description", "giver", "giver_id", "target", "target_id",
+                                 "objective", "reward_currency", "reward_amount", "deadline", "difficulty"],
+                    "additionalProperties": False
+                },
+                "characters": {"type": "array", "items": {"type": "string"}}
+            },
+            "required": ["title", "story", "choices", "mission", "characters"],
+            "additionalProperties": False
+        }
+    }
+}
+
+# Realistic episodes fit comfortably; the old 5000 cap just let pathological
+# generations run long
+_MAX_COMPLETION_TOKENS = 2000
+
+# Invariant variants of the per-request new-character guidance
+_GUIDANCE_NEW_CHARACTER = "IMPORTANT: Include one new character from the database in the choices when needed"
+_GUIDANCE_ENOUGH_CHARACTERS = ("Since there are already {count} characters in this story, "
+                               "only include a new character in choices if absolutely necessary for the plot")
+
+
+@lru_cache(maxsize=1024)
+def _render_selected_character(character: Character) -> str:
+    """Render the featured-character section; cached per Character value
+
+    Sections are built as lists and joined once — repeated '+=' on strings
+    recopies the whole section per line.
+    """
+    character_lines = [
+        "\nSelected Character to Feature:",
+        f"Name: {character.name}",
+        f"Role: {character.role}",
+        f"Traits: {', '.join(character.traits)}",
+        f"Visual Description: {character.style}",
+    ]
+
+    # Add plot lines with emphasis to ensure they're incorporated into the story
+    if character.plot_lines:
+        character_lines.append("Suggested Plot Lines (MUST USE AT LEAST ONE):")
+        character_lines.extend(f"- {plot}" for plot in character.plot_lines)
+
+    return '\n'.join(character_lines) + '\n'
+
+
+@lru_cache(maxsize=1024)
+def _render_additional_characters(characters: Tuple[Character, ...]) -> str:
+    """Render the additional-characters section; cached per roster tuple"""
+    return (
+        "\nAdditional Characters from Database (MUST INCLUDE AT LEAST ONE NEW CHARACTER):\n"
+        + '\n'.join(
+            f"- Name: {char.name}\n"
+            f"  Role: {char.role}\n"
+            f"  Traits: {', '.join(char.traits) if char.traits else 'No specified traits'}"
+            for char in characters
+        )
+        + '\n'
+    )
+
+
+def _build_prompt(
     conflict: str,
     setting: str,
     narrative_style: str,
     mood: str,
-    character_info: Optional[Dict[str, Any]] = None,
+    character_info: Optional[Union[Dict[str, Any], Character]] = None,
     custom_conflict: Optional[str] = None,
     custom_setting: Optional[str] = None,
     custom_narrative: Optional[str] = None,
     custom_mood: Optional[str] = None,
     previous_choice: Optional[str] = None,
     story_context: Optional[str] = None,
-    additional_characters: Optional[List[Dict[str, Any]]] = None,
+    additional_characters: Optional[List[Union[Dict[str, Any], Character]]] = None,
     protagonist_name: Optional[str] = None,
     protagonist_gender: Optional[str] = None,
     protagonist_level: Optional[int] = 1
-) -> Dict[str, Any]:
-    """Generate a story based on selected or custom parameters and character info"""
-    if not api_key:
-        raise ValueError("OpenAI API key not found. Please add it to your environment variables.")
-
-    # Log the story generation request to help debug
-    logger.debug(f"Generating story with conflict: {conflict}, setting: {setting}, using character: {extract_character_name(character_info) if character_info else 'None'}")
-
+) -> Tuple[str, Dict[str, str]]:
+    """Assemble the story prompt. Pure string building — no I/O, safe to call
+    concurrently. Returns the prompt plus the resolved parameter values."""
     # Use custom values if provided, otherwise use selected options
     final_conflict = custom_conflict or conflict
     final_setting = custom_setting or setting
@@ -136,48 +406,14 @@ def generate_story(
     else:
         protagonist_info = "You are a charismatic but reckless agent who constantly receives romantic advances from practically everybody you meet. "
 
-    # Build character information for the prompt
-    selected_character_prompt = ""
-    if character_info and extract_character_name(character_info):
-        # Extract character data using helper functions
-        traits = extract_character_traits(character_info)
-        plot_lines = extract_plot_lines(character_info)
-        style = extract_character_style(character_info)
-
-        # Build the character prompt section with all available data
-        selected_character_prompt = (
-            f"\nSelected Character to Feature:\n"
-            f"Name: {extract_character_name(character_info)}\n"
-            f"Role: {extract_character_role(character_info)}\n"
-            f"Traits: {', '.join(traits)}\n"
-            f"Visual Description: {style}\n"
-        )
+    # Normalize raw character dicts once; everything below is attribute access
+    character = _as_character(character_info)
+    extra_characters = tuple(_as_character(char) for char in additional_characters) if additional_characters else ()
 
-        # Add plot lines with emphasis to ensure they're incorporated into the story
-        if plot_lines:
-            selected_character_prompt += f"Suggested Plot Lines (MUST USE AT LEAST ONE):\n"
-            for plot in plot_lines:
-                selected_character_prompt += f"- {plot}\n"
-
-    # Build information about additional characters from the database
-    additional_characters_prompt = ""
-    if additional_characters and len(additional_characters) > 0:
-        additional_characters_prompt = "\nAdditional Characters from Database (MUST INCLUDE AT LEAST ONE NEW CHARACTER):\n"
-        for char in additional_characters:
-            char_traits = extract_character_traits(char)
-            if isinstance(char_traits, str):
-                # Handle case where traits might be a string
-                char_traits = [char_traits]
-
-            char_name = extract_character_name(char)
-            char_role = extract_character_role(char)
-            traits_str = ', '.join(char_traits) if char_traits else 'No specified traits'
-
-            additional_characters_prompt += (
-                f"- Name: {char_name}\n"
-                f"  Role: {char_role}\n"
-                f"  Traits: {traits_str}\n"
-            )
+    # Character sections render through cached pure functions — the roster
+    # rarely changes between turns, so repeat casts skip the string building
+    selected_character_prompt = _render_selected_character(character) if character else ""
+    additional_characters_prompt = _render_additional_characters(extra_characters) if extra_characters else ""
 
     # Add context from previous choices if available
     context_prompt = ""
@@ -199,130 +435,258 @@ def generate_story(
                 "Continue the story based on this choice, maintaining consistency with previous events."
             )
 
-    # Create a more mission-focused story universe
-    universe_prompt = (
-        f"This is set in the high stakes sexy dramatic international world of business, espionage, luxury, and parties. {protagonist_info}"
-        "The world is mostly as we know it, but there is some future tech and many of the villains have powerful global properties. "
-        "The world is in a state of emergency, and you believe the only way to save it is to party hard, seduce as many people as possible, and have James Bond style adventures with crazy action scenes and gunfights, "
-        "involving more and more beautiful people and increasingly ridiculous scenarios and global settings.\n\n"
-        "All the characters are constantly betraying each other and seducing each other. The narrative should be told directly to the reader (using 'you'), be over-the-top, "
-        "with excessive action scenes, dramatic romantic encounters, and constant plot twists where allies become enemies and vice versa.\n\n"
-        "Each character has international connections and unique skills they use in increasingly absurd ways.\n\n"
-        "IMPORTANT: The story should begin with a mission giver character (any character with the 'mission-giver' role) giving the player a mission. This mission should be a central plot point. The mission giver should be different for different playthroughs. They reluctantly task you with missions targeting villains while reminding you not to screw up again. These missions offer currency rewards when completed."
-    )
+    # Per-request guidance referenced by rules 1 and 4 of the static system
+    # prompt. The character count decides whether to push for a new character.
+    character_count = len(extra_characters) + (1 if character else 0)
+    if character_count >= 4:
+        new_character_guidance = _GUIDANCE_ENOUGH_CHARACTERS.format(count=character_count)
+    else:
+        new_character_guidance = _GUIDANCE_NEW_CHARACTER
+
+    # Only the per-request parts go here; the universe, rules, and response
+    # format live in SYSTEM_PROMPT so the cached prefix stays byte-identical
+    prompt = ''.join((
+        f"Primary Conflict: {final_conflict}\n",
+        f"Setting: {final_setting}\n",
+        f"Narrative Style: {final_narrative}\n",
+        f"Mood: {final_mood}\n"
+        f"Protagonist Level: {protagonist_level or 1}\n\n",
+        protagonist_info, "\n",
+        selected_character_prompt, "\n",
+        additional_characters_prompt, "\n",
+        context_prompt, "\n\n",
+        f"Narrative style for this episode: {final_narrative}\n",
+        f"New-character guidance: {new_character_guidance}",
+    ))
+
+    return prompt, {
+        "conflict": final_conflict,
+        "setting": final_setting,
+        "narrative_style": final_narrative,
+        "mood": final_mood
+    }
+
+
+def _build_messages(prompt: str, story_context: Optional[str] = None,
+                    previous_choice: Optional[str] = None) -> List[Dict[str, str]]:
+    """Build the chat message list for a prompt, including prior context
+
+    The static system prompt always comes first so requests share a common
+    prefix the API can cache; the per-request message goes last.
+    """
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+
+    # If story_context exists, it means we're continuing a story, so we should include previous context
+    if story_context:
+        # Insert the context as part of the message history
+        messages.append({"role": "assistant", "content": f"Previous story context: {story_context}"})
+
+        if previous_choice:
+            messages.append({"role": "user", "content": f"Player chose: {previous_choice}"})
+
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+
+async def _call_llm_async(messages: List[Dict[str, str]]) -> Dict[str, Any]:
+    """Send one chat completion request, backing off on rate limits"""
+    for attempt in range(_MAX_RETRIES):
+        try:
+            response = await _aclient().chat.completions.create(
+                model="gpt-4o-mini",
+                messages=messages,
+                temperature=0.9,
+                max_tokens=_MAX_COMPLETION_TOKENS,
+                response_format=_STORY_RESPONSE_FORMAT
+            )
+            return orjson.loads(response.choices[0].message.content)
+        except RateLimitError:
+            if attempt == _MAX_RETRIES - 1:
+                raise
+            delay = 2 ** attempt
+            logger.warning(f"Rate limited by OpenAI, retrying in {delay}s")
+            await asyncio.sleep(delay)
+
+
+async def _embed_params(final_params: Dict[str, str]) -> List[float]:
+    """Embed the resolved story parameters for semantic cache lookups"""
+    text_key = (f"{final_params['conflict']}|{final_params['setting']}|"
+                f"{final_params['narrative_style']}|{final_params['mood']}")
+    response = await _aclient().embeddings.create(model=_EMBEDDING_MODEL, input=text_key)
+    return response.data[0].embedding
+
+
+def _semantic_lookup(embedding: List[float]) -> Optional[Dict[str, Any]]:
+    """Return the cached response nearest to embedding, if similar enough
+
+    text-embedding-3 vectors are unit-normalized, so the dot product is the
+    cosine similarity. Linear scan is fine at this cache size.
+    """
+    best_score = _SEMANTIC_SIMILARITY_THRESHOLD
+    best_payload = None
+    for cached_embedding, payload in _semantic_cache:
+        score = sum(a * b for a, b in zip(embedding, cached_embedding))
+        if score >= best_score:
+            best_score = score
+            best_payload = payload
+    return best_payload
+
+
+def _semantic_store(embedding: List[float], payload: Dict[str, Any]) -> None:
+    if len(_semantic_cache) >= _SEMANTIC_CACHE_MAX:
+        _semantic_cache.pop(0)
+    _semantic_cache.append((embedding, dict(payload)))
+
+
+async def generate_story_async(
+    conflict: str,
+    setting: str,
+    narrative_style: str,
+    mood: str,
+    character_info: Optional[Dict[str, Any]] = None,
+    custom_conflict: Optional[str] = None,
+    custom_setting: Optional[str] = None,
+    custom_narrative: Optional[str] = None,
+    custom_mood: Optional[str] = None,
+    previous_choice: Optional[str] = None,
+    story_context: Optional[str] = None,
+    additional_characters: Optional[List[Dict[str, Any]]] = None,
+    protagonist_name: Optional[str] = None,
+    protagonist_gender: Optional[str] = None,
+    protagonist_level: Optional[int] = 1
+) -> Dict[str, Any]:
+    """Generate a story based on selected or custom parameters and character info"""
+    if not api_key:
+        raise ValueError("OpenAI API key not found. Please add it to your environment variables.")
+
+    # Normalize once up front; _build_prompt passes Characters through untouched
+    character_info = _as_character(character_info)
 
-    # Construct the main prompt
-    prompt = (
-        f"Primary Conflict: {final_conflict}\n"
-        f"Setting: {final_setting}\n"
-        f"Narrative Style: {final_narrative}\n"
-        f"Mood: {final_mood}\n\n"
-        f"{universe_prompt}\n"
-        f"{selected_character_prompt}\n"
-        f"{additional_characters_prompt}\n"
-        f"{context_prompt}\n\n"
-        "Create an engaging story introduction that:\n"
-        f"1. Features the reader as 'you' (second-person narrative) as the main story driver with {final_narrative} narrative style\n"
-        "2. Introduces the selected character (if provided) into a complex international spy scenario\n"
-        "3. IMPORTANT: If plot lines are provided for the character, you MUST incorporate at least one into the story\n"
-        "4. " + (f"Since there are already {len(additional_characters) + (1 if character_info else 0)} characters in this story, only include a new character in choices if absolutely necessary for the plot" if len(additional_characters) + (1 if character_info else 0) >= 4 else
-                "IMPORTANT: Include one new character from the database in the choices when needed") + "\n"
-        "5. Includes betrayal, romantic flings, and over-the-top action sequences\n"
-        "6. Uses the character's traits to guide their behavior and dialogue\n"
-        "7. CRITICAL: The story MUST begin with a mission-giver character assigning a mission to the player with these components:\n"
-        "   - A clear objective (steal an item, sabotage a plan, investigate a location, etc.)\n"
-        "   - A specific target character who has the 'villain' role\n"
-        "   - A large reward in one of the game currencies (💵, 💷, 💶, 💴)\n"
-        "   - A deadline or sense of urgency\n"
-        "   - The mission should be central to the plot and referenced throughout the story\n"
-        "   - IMPORTANT: The mission giver should be different for different playthroughs. They reluctantly task you with missions targeting villains while reminding you not to screw up again.\n"
-
-        "9. Provides three meaningful choice options that MUST relate to the mission:\n"
-        "   - One 'mission-advancing' choice: Clear progress on the primary objective\n" 
-        "   - One 'risky' choice: High risk/reward or possible mission failure\n"
-        "   - One 'alternative' choice: Indirect help, intel gathering, new allies, or a delay\n"
-        "   - Lead to different potential outcomes (each one should sound sexy and dangerous)\n"
-        "   - Stay true to the characters' established traits\n"
-        "   - Relate to at least one of the plot lines or missions \n"
-        "   - IMPORTANT: One choice must allude to maybe needing outside help and introduce a new character from the database \n"
-        "   - REQUIRED: Each choice must have a dollar (💵) cost starting at $500, with increased costs for choices that: involve powerful characters, have higher risk/reward, include exotic locations, or advanced technology\n"
-        "   - Avoid dead ends but escalate the ridiculousness with each choice\n"
-        "10. Include clear consequences for each choice that involve romantic encounters, betrayal, or absurd action scenarios\n"
-        "11. If player has an active mission, reference it and potentially provide progress updates\n\n"
-        "Format the response as a JSON object with:\n"
-        "{\n"
-        "  'title': 'Episode title',\n"
-        "  'story': 'The story text with integrated mission assignment',\n"
-        "  'choices': [\n"
-        "    {\n"
-        "      'text': 'First choice related to the mission',\n"
-        "      'consequence': 'Brief outcome hint',\n"
-        "      'currency_requirements': {'💵': 500 + random.randint(0, min(1000, 200 * (protagonist_level or 1)))},\n"
-        "      'mission_impact': 'Describe how this choice affects the mission (advancing it)',\n"
-        "      'type': 'mission-advancing'\n"
-        "    },\n"
-        "    {\n"
-        "      'text': 'Second choice with high risk/reward',\n"
-        "      'consequence': 'Possible danger or unexpected outcome',\n"
-        "      'currency_requirements': {'💵': 750 + random.randint(0, min(1500, 300 * (protagonist_level or 1)))},\n"
-        "      'mission_impact': 'High risk impact on mission (potential failure or big success)',\n"
-        "      'type': 'risky'\n"
-        "    },\n"
-        "    {\n"
-        "      'text': 'Third choice, an alternative approach',\n"
-        "      'consequence': 'Outcome hint, like gaining allies or resources',\n"
-        "      'currency_requirements': {'💵': 600 + random.randint(0, min(1200, 250 * (protagonist_level or 1)))},\n"
-        "      'mission_impact': 'Alternative path that may help indirectly',\n"
-        "      'type': 'alternative'\n"
-        "    }\n"
-        "  ],\n"
-        "  'mission': {\n"
-        "    'title': 'Mission title',\n"
-        "    'description': 'Detailed mission description',\n"
-        "    'giver': 'Name of character who gave the mission',\n"
-        "    'giver_id': 'ID of the character who gave the mission',\n"
-        "    'target': 'Name of target character (villain)',\n"
-        "    'target_id': 'ID of target character',\n"
-        "    'objective': 'What the player must do',\n"
-        "    'reward_currency': 'Currency symbol (💎, 💵, etc.)',\n"
-        "    'reward_amount': 'Amount of reward',\n"
-        "    'deadline': 'Narrative deadline description',\n"
-        "    'difficulty': 'Easy, Medium, or Hard'\n"
-        "  },\n"
-        "  'characters': ['List of character names featured, including new characters']\n"
-        "}"
+    # Log the story generation request to help debug
+    logger.debug("Generating story with conflict: %s, setting: %s, using character: %s",
+                 conflict, setting, character_info.name if character_info else 'None')
+
+    prompt, final_params = _build_prompt(
+        conflict=conflict,
+        setting=setting,
+        narrative_style=narrative_style,
+        mood=mood,
+        character_info=character_info,
+        custom_conflict=custom_conflict,
+        custom_setting=custom_setting,
+        custom_narrative=custom_narrative,
+        custom_mood=custom_mood,
+        previous_choice=previous_choice,
+        story_context=story_context,
+        additional_characters=additional_characters,
+        protagonist_name=protagonist_name,
+        protagonist_gender=protagonist_gender,
+        protagonist_level=protagonist_level
     )
 
+    # Openings with identical parameters produce an identical prompt, so a
+    # repeat can be served straight from the cache
+    cacheable = story_context is None and previous_choice is None
+    cache_key = hashlib.sha256(prompt.encode()).hexdigest() if cacheable else None
+    if cache_key is not None and (cached := _story_cache.get(cache_key)):
+        logger.debug("Story cache hit for prompt %.12s", cache_key)
+        return dict(cached)
+
+    # Free-text custom fields rarely repeat verbatim, so fall back to a
+    # nearest-neighbour lookup on an embedding of the resolved parameters.
+    # One cheap embedding call replaces a full generation on a hit.
+    has_custom = any((custom_conflict, custom_setting, custom_narrative, custom_mood))
+    embedding = None
+    if cacheable and has_custom:
+        try:
+            embedding = await _embed_params(final_params)
+            if (semantic_hit := _semantic_lookup(embedding)) is not None:
+                logger.debug("Semantic cache hit for custom story parameters")
+                return dict(semantic_hit)
+        except Exception as e:
+            logger.warning(f"Semantic cache lookup failed, generating anyway: {str(e)}")
+
     # Make the OpenAI API call
     try:
-        messages = [{"role": "user", "content": prompt}]
-
-        # If story_context exists, it means we're continuing a story, so we should include previous context
-        if story_context:
-            # Insert the context as part of the message history
-            messages.insert(1, {"role": "assistant", "content": f"Previous story context: {story_context}"})
-
-            if previous_choice:
-                messages.insert(2, {"role": "user", "content": f"Player chose: {previous_choice}"})
-
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            temperature=0.9,
-            max_tokens=5000,
-            response_format={"type": "json_object"}
-        )
-
-        # Parse and return the generated story
-        result = json.loads(response.choices[0].message.content)
-        return {
-            "story": json.dumps(result),  # Convert dict to JSON string for database storage
-            "conflict": final_conflict,
-            "setting": final_setting,
-            "narrative_style": final_narrative,
-            "mood": final_mood
+        messages = _build_messages(prompt, story_context, previous_choice)
+        result = await _call_llm_async(messages)
+        payload = {
+            "story": result,  # Parsed dict; the JSONB column serializes once on write
+            **final_params
         }
+        if cache_key is not None:
+            if len(_story_cache) >= _STORY_CACHE_MAX:
+                # Drop the oldest entry; insertion order is good enough here
+                _story_cache.pop(next(iter(_story_cache)))
+            _story_cache[cache_key] = dict(payload)
+        if embedding is not None:
+            _semantic_store(embedding, payload)
+        return payload
 
     except Exception as e:
         logger.error(f"Error generating story: {str(e)}")
-        raise Exception(f"Failed to generate story: {str(e)}")
\ No newline at end of file
+        raise Exception(f"Failed to generate story: {str(e)}")
+
+
+async def generate_stories_batch(
+    param_dicts: List[Dict[str, Any]],
+    max_concurrent: int = MAX_CONCURRENT_GENERATIONS
+) -> List[Dict[str, Any]]:
+    """Generate several stories concurrently.
+
+    Fires every request at once (bounded by a semaphore so we respect
+    OpenAI rate limits), so K generations take ~max(T) instead of K*T.
+    """
+    semaphore = asyncio.Semaphore(max_concurrent)
+
+    async def _bounded(params: Dict[str, Any]) -> Dict[str, Any]:
+        async with semaphore:
+            return await generate_story_async(**params)
+
+    return await asyncio.gather(*[_bounded(params) for params in param_dicts])
+
+
+async def stream_story(**kwargs):
+    """Stream a story generation as it is produced.
+
+    Yields ("delta", text) for each content chunk as it arrives, then a
+    final ("story", result) carrying the same payload generate_story_async
+    returns. Lets the UI render at first-chunk latency (~hundreds of ms)
+    instead of waiting out the full completion.
+    """
+    if not api_key:
+        raise ValueError("OpenAI API key not found. Please add it to your environment variables.")
+
+    prompt, final_params = _build_prompt(**kwargs)
+    messages = _build_messages(prompt, kwargs.get('story_context'), kwargs.get('previous_choice'))
+
+    response = await _aclient().chat.completions.create(
+        model="gpt-4o-mini",
+        messages=messages,
+        temperature=0.9,
+        max_tokens=_MAX_COMPLETION_TOKENS,
+        response_format=_STORY_RESPONSE_FORMAT,
+        stream=True
+    )
+
+    buffer: List[str] = []
+    async for chunk in response:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            buffer.append(delta)
+            yield ("delta", delta)
+
+    # The concatenated stream is the same JSON object the non-streaming
+    # call returns; parse once at the end for the structured final event
+    result = orjson.loads(''.join(buffer))
+    yield ("story", {
+        "story": result,
+        **final_params
+    })
+
+
+def generate_story(*args, **kwargs) -> Dict[str, Any]:
+    """Synchronous wrapper around generate_story_async for existing callers"""
+    return asyncio.run(generate_story_async(*args, **kwargs))
\ No newline at end of file
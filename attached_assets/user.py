@@ -1,12 +1,19 @@
 
+import bisect
 import logging
 from datetime import datetime
-import math
 from .base import db
+from sqlalchemy import cast, func, text, update
 from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.mutable import MutableDict, MutableList
 
 logger = logging.getLogger(__name__)
 
+# XP thresholds where the level increments, equivalent to
+# level = 1 + sqrt(xp/100): 100, 400, 900, ... A bisect over this table
+# replaces the float sqrt on every XP grant; level caps at 100.
+_LEVEL_XP = [i * i * 100 for i in range(1, 100)]
+
 class UserProgress(db.Model):
     """Model for tracking user progress in stories"""
     id = db.Column(db.Integer, primary_key=True)
@@ -16,24 +23,28 @@ class UserProgress(db.Model):
     level = db.Column(db.Integer, default=1)  # User's game level
     experience_points = db.Column(db.Integer, default=0)  # XP for leveling up
     last_updated = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
-    choice_history = db.Column(JSONB, default=[])  # Track user's choice history as an array
-    achievements_earned = db.Column(JSONB, default=[])  # Track earned achievements
-    game_state = db.Column(JSONB, default={})  # Store additional game state data
-    
+    # Mutable-tracked so in-place appends/updates mark the column dirty
+    # without re-assigning the whole value
+    choice_history = db.Column(MutableList.as_mutable(JSONB), default=list)  # Track user's choice history as an array
+    achievements_earned = db.Column(MutableList.as_mutable(JSONB), default=list)  # Track earned achievements
+    game_state = db.Column(MutableDict.as_mutable(JSONB), default=dict)  # Store additional game state data
+
     # Track active plot arcs
-    active_plot_arcs = db.Column(JSONB, default=[])  # IDs of active plot arcs
-    completed_plot_arcs = db.Column(JSONB, default=[])  # IDs of completed plot arcs
+    active_plot_arcs = db.Column(MutableList.as_mutable(JSONB), default=list)  # IDs of active plot arcs
+    completed_plot_arcs = db.Column(MutableList.as_mutable(JSONB), default=list)  # IDs of completed plot arcs
     
-    # Track mission progress
-    active_missions = db.Column(JSONB, default=[])  # IDs of active missions
-    completed_missions = db.Column(JSONB, default=[])  # IDs of completed missions
-    failed_missions = db.Column(JSONB, default=[])  # IDs of failed missions
+    # Track mission progress. Stored as set-like JSONB objects
+    # ({"<mission_id>": 1, ...}) so membership checks and removals are O(1)
+    # instead of scanning a list
+    active_missions = db.Column(MutableDict.as_mutable(JSONB), default=dict)  # IDs of active missions
+    completed_missions = db.Column(MutableDict.as_mutable(JSONB), default=dict)  # IDs of completed missions
+    failed_missions = db.Column(MutableDict.as_mutable(JSONB), default=dict)  # IDs of failed missions
     
     # Track encountered characters
-    encountered_characters = db.Column(JSONB, default={})  # Dict with character_id -> relationship level
-    
+    encountered_characters = db.Column(MutableDict.as_mutable(JSONB), default=dict)  # Dict with character_id -> relationship level
+
     # Currency balances stored as JSONB
-    currency_balances = db.Column(JSONB, default={
+    currency_balances = db.Column(MutableDict.as_mutable(JSONB), default=lambda: {
         "💎": 500,  # Diamonds
         "💷": 5000,  # Pounds
         "💶": 5000,  # Euros
@@ -58,26 +69,45 @@ class UserProgress(db.Model):
         if not currency_requirements:
             return True
 
-        for currency, amount in currency_requirements.items():
-            if self.currency_balances.get(currency, 0) < amount:
-                logger.debug(f"User {self.user_id} cannot afford {amount} {currency}")
-                return False
-        logger.debug(f"User {self.user_id} can afford requirements: {currency_requirements}")
-        return True
+        balances = self.currency_balances
+        affordable = all(balances.get(currency, 0) >= amount
+                         for currency, amount in currency_requirements.items())
+        # Gate the log so the message isn't formatted when debug is off
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("User %s %s afford requirements: %s",
+                         self.user_id, "can" if affordable else "cannot", currency_requirements)
+        return affordable
+
+    # The mutation methods below default to commit=False so one player action
+    # (spend + record choice + encounter + XP) can batch into a single commit
+    # at the end of the request instead of one fsync per method.
 
-    def spend_currency(self, currency_requirements, transaction_type, description, story_node_id=None):
+    def spend_currency(self, currency_requirements, transaction_type, description, story_node_id=None, commit=False):
         """Spend currency and record transaction"""
-        if not self.can_afford(currency_requirements):
-            logger.warning(f"User {self.user_id} attempted to spend currency they don't have")
-            return False
+        # Validate and compute the new balances in one pass, applying only
+        # if every deduction stays non-negative
+        balances = self.currency_balances
+        new_balances = {}
+        for currency, amount in currency_requirements.items():
+            remaining = balances.get(currency, 0) - amount
+            if remaining < 0:
+                logger.warning(f"User {self.user_id} attempted to spend currency they don't have")
+                return False
+            new_balances[currency] = remaining
 
         try:
-            # Update balances
-            for currency, amount in currency_requirements.items():
-                self.currency_balances[currency] = self.currency_balances.get(currency, 0) - amount
+            # Chain one jsonb_set per currency so only the touched keys are
+            # rewritten, not the whole balances blob
+            balances_col = func.coalesce(UserProgress.currency_balances, text("'{}'::jsonb"))
+            for currency, remaining in new_balances.items():
+                balances_col = func.jsonb_set(
+                    balances_col, '{%s}' % currency,
+                    func.to_jsonb(cast(remaining, db.Integer)))
 
-                # Record transaction
-                transaction = Transaction(
+            # Transactions are write-only audit rows; bulk_save_objects skips
+            # the identity-map and event bookkeeping of per-row add()
+            db.session.bulk_save_objects([
+                Transaction(
                     user_id=self.user_id,
                     transaction_type=transaction_type,
                     from_currency=currency,
@@ -85,21 +115,48 @@ class UserProgress(db.Model):
                     description=description,
                     story_node_id=story_node_id
                 )
-                db.session.add(transaction)
+                for currency, amount in currency_requirements.items()
+            ])
 
-            db.session.commit()
-            logger.info(f"Successfully processed currency transaction for user {self.user_id}")
+            db.session.execute(
+                update(UserProgress)
+                .where(UserProgress.id == self.id)
+                .values(currency_balances=balances_col))
+            db.session.expire(self, ['currency_balances'])
+
+            # Keep the denormalized per-currency rows in step with the
+            # JSONB balances
+            for currency, amount in currency_requirements.items():
+                UserCurrency.credit(self.user_id, currency, -amount)
+
+            if commit:
+                db.session.commit()
+            logger.info("Successfully processed currency transaction for user %s", self.user_id)
             return True
         except Exception as e:
             logger.error(f"Failed to process currency transaction: {str(e)}")
             db.session.rollback()
             return False
             
-    def add_currency(self, currency, amount, transaction_type, description):
+    def add_currency(self, currency, amount, transaction_type, description, commit=False):
         """Add currency and record transaction"""
         try:
-            # Update balance
-            self.currency_balances[currency] = self.currency_balances.get(currency, 0) + amount
+            # Increment the one key server-side; avoids rewriting the whole
+            # blob and is safe against concurrent credits
+            current = func.coalesce(
+                cast(UserProgress.currency_balances[currency].astext, db.Integer), 0)
+            db.session.execute(
+                update(UserProgress)
+                .where(UserProgress.id == self.id)
+                .values(currency_balances=func.jsonb_set(
+                    func.coalesce(UserProgress.currency_balances, text("'{}'::jsonb")),
+                    '{%s}' % currency,
+                    func.to_jsonb(current + amount))))
+            db.session.expire(self, ['currency_balances'])
+
+            # Keep the denormalized per-currency row in step with the
+            # JSONB balances
+            UserCurrency.credit(self.user_id, currency, amount)
 
             # Record transaction
             transaction = Transaction(
@@ -111,97 +168,139 @@ class UserProgress(db.Model):
             )
             db.session.add(transaction)
 
-            db.session.commit()
-            logger.info(f"Added {amount} {currency} to user {self.user_id}")
+            if commit:
+                db.session.commit()
+            logger.info("Added %s %s to user %s", amount, currency, self.user_id)
             return True
         except Exception as e:
             logger.error(f"Failed to add currency: {str(e)}")
             db.session.rollback()
             return False
             
-    def record_choice(self, choice_text, choice_id, node_id, story_id):
+    # The timestamp kwarg lets a request handler format utcnow once and share
+    # it across every model write in the action, as the CharacterEvolution
+    # helpers already do.
+
+    def record_choice(self, choice_text, choice_id, node_id, story_id, commit=False, timestamp=None):
         """Record a story choice in the user's history"""
-        if not self.choice_history:
-            self.choice_history = []
-            
         choice_data = {
             "choice_id": choice_id,
             "choice_text": choice_text,
             "node_id": node_id,
             "story_id": story_id,
-            "timestamp": datetime.utcnow().isoformat()
+            "timestamp": timestamp or datetime.utcnow().isoformat()
         }
         
         self.choice_history.append(choice_data)
         self.current_node_id = node_id
         self.current_story_id = story_id
-        db.session.commit()
+        if commit:
+            db.session.commit()
         return True
         
-    def encounter_character(self, character_id, character_name, initial_relationship=0):
-        """Record character encounter and initialize or update relationship"""
-        if not self.encountered_characters:
-            self.encountered_characters = {}
-            
-        if str(character_id) not in self.encountered_characters:
+    def encounter_character(self, character_id, character_name, initial_relationship=0, commit=False, timestamp=None):
+        """Record character encounter and initialize or update relationship
+
+        Writes go through jsonb_set so only the touched entry is rewritten;
+        for a veteran user the encounter dict can be large and re-serializing
+        it on every encounter amplifies each write by the full blob size.
+        """
+        char_key = str(character_id)
+        now_iso = timestamp or datetime.utcnow().isoformat()
+        col = func.coalesce(UserProgress.encountered_characters, text("'{}'::jsonb"))
+
+        if char_key not in (self.encountered_characters or {}):
             # First encounter with this character
-            self.encountered_characters[str(character_id)] = {
+            entry = {
                 "name": character_name,
                 "relationship_level": initial_relationship,
-                "first_encounter": datetime.utcnow().isoformat(),
+                "first_encounter": now_iso,
                 "encounters_count": 1,
-                "last_encounter": datetime.utcnow().isoformat()
+                "last_encounter": now_iso
             }
+            new_col = func.jsonb_set(col, '{%s}' % char_key, cast(entry, JSONB))
         else:
             # Update existing character relationship
-            self.encountered_characters[str(character_id)]["encounters_count"] += 1
-            self.encountered_characters[str(character_id)]["last_encounter"] = datetime.utcnow().isoformat()
-            
-        db.session.commit()
+            bumped_count = func.to_jsonb(func.coalesce(
+                cast(UserProgress.encountered_characters[char_key]['encounters_count'].astext, db.Integer), 0) + 1)
+            new_col = func.jsonb_set(
+                func.jsonb_set(col, '{%s,encounters_count}' % char_key, bumped_count),
+                '{%s,last_encounter}' % char_key,
+                func.to_jsonb(cast(now_iso, db.Text)))
+
+        db.session.execute(
+            update(UserProgress).where(UserProgress.id == self.id).values(encountered_characters=new_col))
+        db.session.expire(self, ['encountered_characters'])
+
+        if commit:
+            db.session.commit()
         return True
         
-    def change_character_relationship(self, character_id, change_amount, reason=None):
+    def change_character_relationship(self, character_id, change_amount, reason=None, commit=False, timestamp=None):
         """Change relationship level with a character"""
         if not self.encountered_characters or str(character_id) not in self.encountered_characters:
             logger.warning(f"User {self.user_id} tried to change relationship with unknown character {character_id}")
             return False
             
-        char_data = self.encountered_characters[str(character_id)]
-        char_data["relationship_level"] += change_amount
-        
+        char_key = str(character_id)
+        col = UserProgress.encountered_characters
+
+        # Adjust the level in place rather than rewriting the whole entry
+        new_level = func.to_jsonb(func.coalesce(
+            cast(col[char_key]['relationship_level'].astext, db.Integer), 0) + change_amount)
+        new_col = func.jsonb_set(col, '{%s,relationship_level}' % char_key, new_level)
+
         if reason:
-            if "relationship_history" not in char_data:
-                char_data["relationship_history"] = []
-                
-            char_data["relationship_history"].append({
+            # Append to the history array server-side ('||' concatenates)
+            history_entry = [{
                 "change": change_amount,
                 "reason": reason,
-                "timestamp": datetime.utcnow().isoformat()
-            })
-            
-        self.encountered_characters[str(character_id)] = char_data
-        db.session.commit()
+                "timestamp": timestamp or datetime.utcnow().isoformat()
+            }]
+            new_history = func.coalesce(
+                col[char_key]['relationship_history'],
+                text("'[]'::jsonb")
+            ).op('||')(cast(history_entry, JSONB))
+            new_col = func.jsonb_set(new_col, '{%s,relationship_history}' % char_key, new_history)
+
+        db.session.execute(
+            update(UserProgress).where(UserProgress.id == self.id).values(encountered_characters=new_col))
+        db.session.expire(self, ['encountered_characters'])
+
+        if commit:
+            db.session.commit()
         return True
         
-    def add_experience_points(self, points, reason=None):
+    def add_experience_points(self, points, reason=None, commit=False):
         """Add experience points and handle leveling up"""
         self.experience_points += points
-        
-        # Simple leveling formula: level = 1 + sqrt(xp/100)
-        new_level = 1 + int(math.sqrt(self.experience_points / 100))
-        
+        level_up = self.apply_level_for_xp(self.experience_points)
+        if commit:
+            db.session.commit()
+        return level_up
+
+    def apply_level_for_xp(self, total_xp):
+        """Sync the level to a known XP total and award any level-up bonus
+
+        Split out of add_experience_points so callers that increment XP
+        server-side can pass the total RETURNING gave them instead of
+        re-reading the row.
+        """
+        # Simple leveling formula: level = 1 + sqrt(xp/100), via the
+        # precomputed threshold table
+        new_level = 1 + bisect.bisect_right(_LEVEL_XP, total_xp)
+
         level_up = new_level > self.level
         if level_up:
             old_level = self.level
             self.level = new_level
-            logger.info(f"User {self.user_id} leveled up from {old_level} to {new_level}")
-            
+            logger.info("User %s leveled up from %s to %s", self.user_id, old_level, new_level)
+
             # Award level-up bonus
             level_bonus = 50 * new_level
             self.add_currency("💶", level_bonus, "level_up", f"Level up bonus for reaching level {new_level}")
-            
-        db.session.commit()
+
         return level_up
 
 # Need to import Transaction here to avoid circular dependency
-from .currency import Transaction
+from .currency import Transaction, UserCurrency
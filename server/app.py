@@ -1,22 +1,69 @@
 
+# Patch sockets before anything imports ssl/socket so the multi-second
+# OpenAI waits yield the greenlet instead of blocking the whole worker.
+# The OpenAI client rides on httpx (pure Python), so the patch applies.
+try:
+    from gevent import monkey
+    monkey.patch_all()
+except ImportError:  # dev environments without gevent still work, serially
+    pass
+
 from flask import Flask, request, jsonify
-import json
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.routing import BaseConverter
+import asyncio
+import copy
+import hashlib
+from math import isqrt
 import os
 import logging
+import orjson
 from flask_cors import CORS
+from flask_compress import Compress
 import sys
 
 # Add the parent directory to the path so we can import the modules
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 # Import the modules from attached assets
-from attached_assets.story_maker import generate_story, get_story_options
+from attached_assets.story_maker import get_story_options_json, stream_story
 from attached_assets.mission_generator import generate_mission, complete_mission, fail_mission
 from attached_assets.character_evolution_service import evolve_character_traits, update_character_relationships
+from llm_cache import cached_generate_story, prefetch_generate_story, story_cache
+from store import store, user_lock
+
+class UidConverter(BaseConverter):
+    """User-id path segments, validated by Werkzeug's compiled route regex"""
+    regex = r'[A-Za-z0-9_\-]{1,64}'
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Serialize responses with orjson instead of the stdlib json module
+
+    Story payloads are a few KB of nested dicts per response; orjson
+    encodes them several times faster and jsonify picks this up
+    automatically.
+    """
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 app = Flask(__name__)
+app.url_map.converters['uid'] = UidConverter
+app.json = OrjsonProvider(app)
 CORS(app)
 
+# Story payloads are multi-KB JSON; compressing them cuts the wire size
+# severalfold for clients on slow links. Prefer brotli/zstd over gzip,
+# and skip tiny responses where headers would eat the savings.
+app.config['COMPRESS_ALGORITHM'] = ['br', 'zstd', 'gzip']
+app.config['COMPRESS_MIN_SIZE'] = 512
+Compress(app)
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -26,44 +73,141 @@ api_key = os.environ.get("OPENAI_API_KEY")
 if not api_key:
     logger.warning("OpenAI API key not found in environment variables")
 
-# Mock database for prototyping (will be replaced with real DB later)
-users = {}
-stories = {}
+# Users and stories live in the store (Redis when REDIS_URL is set, an
+# in-process dict otherwise) so gunicorn workers share state. The rest is
+# still mock data for prototyping.
 story_nodes = {}
 story_choices = {}
 characters = {}
 
+# Story and mission IDs come from the store (Redis INCR when configured,
+# a per-process counter otherwise) so concurrent workers never collide.
+
+# Starting state for a new user; deepcopy per signup so users never share
+# the nested dicts/lists
+_USER_TEMPLATE = {
+    'current_node_id': None,
+    'current_story_id': None,
+    'level': 1,
+    'experience_points': 0,
+    'currency_balances': {
+        "💎": 500,  # Diamonds
+        "💷": 5000,  # Pounds
+        "💶": 5000,  # Euros
+        "💴": 5000,  # Yen
+        "💵": 5000,  # Dollars
+    },
+    # Keyed by mission_id so lookup/removal is O(1) instead of a
+    # list scan; responses convert back to arrays for clients
+    'active_missions': {},
+    'completed_missions': {},
+    'encountered_characters': {},
+    'choice_history': []
+}
+
+def progress_view(user_data):
+    """User progress shaped for API responses
+
+    Missions are stored dict-indexed for O(1) lookup; clients expect
+    arrays, so convert only at the serialization boundary.
+    """
+    return {
+        **user_data,
+        'active_missions': list(user_data['active_missions'].values()),
+        'completed_missions': list(user_data['completed_missions'].values()),
+    }
+
+def _persist_story(story_result, user_id, parent_story_id=None):
+    """Save a generated story and return (story_id, story_data)
+
+    Single save path for the buffered, streaming, and choice routes so
+    the stored shape can't drift between them.
+    """
+    story_id = store.next_story_id()
+    story_data = story_result['story']
+    store.set_story(story_id, {
+        'id': story_id,
+        'user_id': user_id,
+        'conflict': story_result['conflict'],
+        'setting': story_result['setting'],
+        'narrative_style': story_result['narrative_style'],
+        'mood': story_result['mood'],
+        'generated_story': story_data,
+        'created_at': None,  # Would be a timestamp in a real DB
+        'parent_story_id': parent_story_id
+    })
+    return story_id, story_data
+
+def _add_story_mission(user_data, story_data, story_id):
+    """Create an active mission from the story's mission block, if any
+
+    Keyed by the stringified mission id so the mapping round-trips
+    through JSON unchanged.
+    """
+    mission_src = story_data.get('mission')
+    if not mission_src:
+        return
+    mission_id = store.next_mission_id()
+    user_data['active_missions'][str(mission_id)] = {
+        'id': mission_id,
+        'title': mission_src.get('title', ''),
+        'description': mission_src.get('description', ''),
+        'status': 'active',
+        'reward_currency': mission_src.get('reward_currency', '💵'),
+        'reward_amount': mission_src.get('reward_amount', 1000),
+        'progress': 0,
+        'story_id': story_id
+    }
+
+def prefetch_choice_continuations(story_result, story_data):
+    """Warm the LLM cache with the continuations of a story's choices
+
+    Whichever choice the player picks next becomes a cache hit instead of
+    a fresh multi-second generation. Runs in the background; the kwargs
+    mirror exactly what make_choice will request.
+    """
+    prefetch_generate_story([
+        {
+            'conflict': story_result['conflict'],
+            'setting': story_result['setting'],
+            'narrative_style': story_result['narrative_style'],
+            'mood': story_result['mood'],
+            'previous_choice': choice['text'],
+            'story_context': story_data.get('story', '')
+        }
+        for choice in story_data.get('choices', [])
+        if isinstance(choice, dict) and choice.get('text')
+    ])
+
+# The options payload is static, so the body and its ETag are computed once
+_OPTIONS_BODY = get_story_options_json()
+_OPTIONS_ETAG = '"%s"' % hashlib.blake2b(_OPTIONS_BODY.encode(), digest_size=8).hexdigest()
+_OPTIONS_HEADERS = {'ETag': _OPTIONS_ETAG, 'Cache-Control': 'public, max-age=3600'}
+
 @app.route('/api/story/options', methods=['GET'])
 def get_story_options_route():
     """Return available story options for UI display"""
-    return jsonify(get_story_options())
+    # Revalidating clients get an empty 304 instead of the full payload
+    if _OPTIONS_ETAG in request.headers.get('If-None-Match', ''):
+        return app.response_class(status=304, headers=_OPTIONS_HEADERS)
+    return app.response_class(_OPTIONS_BODY, mimetype='application/json',
+                              headers=_OPTIONS_HEADERS)
 
 @app.route('/api/story/generate', methods=['POST'])
 def generate_story_route():
     """Generate a new story based on options"""
-    data = request.json
+    data = request.get_json()
     user_id = data.get('user_id', 'default_user')
-    
-    # Create user if not exists
-    if user_id not in users:
-        users[user_id] = {
-            'current_node_id': None,
-            'current_story_id': None,
-            'level': 1,
-            'experience_points': 0,
-            'currency_balances': {
-                "💎": 500,  # Diamonds
-                "💷": 5000,  # Pounds
-                "💶": 5000,  # Euros
-                "💴": 5000,  # Yen
-                "💵": 5000,  # Dollars
-            },
-            'active_missions': [],
-            'completed_missions': [],
-            'encountered_characters': {},
-            'choice_history': []
-        }
-    
+
+    # Create user if not exists. Only the state read/write sections take
+    # the user lock — holding it across the multi-second generation would
+    # stall every other request contending for the same lock.
+    with user_lock(user_id):
+        user_data = store.get_user(user_id)
+        if user_data is None:
+            user_data = copy.deepcopy(_USER_TEMPLATE)
+            store.set_user(user_id, user_data)
+
     try:
         # Extract parameters for story generation
         conflict = data.get('conflict', '')
@@ -77,10 +221,11 @@ def generate_story_route():
         custom_mood = data.get('custom_mood')
         protagonist_name = data.get('protagonist_name')
         protagonist_gender = data.get('protagonist_gender')
-        protagonist_level = users[user_id]['level']
+        protagonist_level = user_data['level']
         
-        # Generate story
-        story_result = generate_story(
+        # Generate story (served from the LLM cache when the same
+        # parameters have been seen before)
+        story_result = cached_generate_story(
             conflict=conflict,
             setting=setting,
             narrative_style=narrative_style,
@@ -95,121 +240,187 @@ def generate_story_route():
             protagonist_level=protagonist_level
         )
         
-        # Create story ID and save
-        story_id = len(stories) + 1
-        story_data = json.loads(story_result['story'])
-        stories[story_id] = {
-            'id': story_id,
-            'user_id': user_id,
-            'conflict': story_result['conflict'],
-            'setting': story_result['setting'],
-            'narrative_style': story_result['narrative_style'],
-            'mood': story_result['mood'],
-            'generated_story': story_data,
-            'created_at': None  # Would be a timestamp in a real DB
-        }
-        
-        # Create a mission if one in the story
-        if 'mission' in story_data:
-            mission_id = len(users[user_id]['active_missions']) + 1
-            users[user_id]['active_missions'].append({
-                'id': mission_id,
-                'title': story_data.get('mission', {}).get('title', ''),
-                'description': story_data.get('mission', {}).get('description', ''),
-                'status': 'active',
-                'reward_currency': story_data.get('mission', {}).get('reward_currency', '💵'),
-                'reward_amount': story_data.get('mission', {}).get('reward_amount', 1000),
-                'progress': 0,
-                'story_id': story_id
-            })
-            
-        # Update user's current story
-        users[user_id]['current_story_id'] = story_id
-        
+        # Create story ID, save, and create a mission if one in the story.
+        # Re-fetch the user under the lock: another request may have
+        # advanced their state while the generation ran.
+        story_id, story_data = _persist_story(story_result, user_id)
+        with user_lock(user_id):
+            user_data = store.get_user(user_id)
+            _add_story_mission(user_data, story_data, story_id)
+            user_data['current_story_id'] = story_id
+            store.set_user(user_id, user_data)
+
+        # Speculatively pre-generate the continuations the player can reach
+        prefetch_choice_continuations(story_result, story_data)
+
         # Return the generated story
         return jsonify({
             'story_id': story_id,
             'generated_story': story_data,
-            'user_progress': users[user_id]
+            'user_progress': progress_view(user_data)
         })
         
     except Exception as e:
         logger.error(f"Error generating story: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/story/generate/stream', methods=['POST'])
+def generate_story_stream_route():
+    """Stream a story generation as Server-Sent Events
+
+    Tokens are forwarded to the client as OpenAI produces them, so the
+    first words appear at first-token latency instead of after the full
+    5-30s completion. Each delta arrives as a {"delta": text} event; the
+    final event carries the same story_id/generated_story/user_progress
+    payload as the JSON endpoint, saved the same way. Needs gevent (or
+    another async worker) to stream without blocking the worker.
+    """
+    data = request.get_json()
+    user_id = data.get('user_id', 'default_user')
+
+    # Create user if not exists. Persisted right away — the rest of the
+    # handler runs as a generator after the request returns, so the user
+    # must exist even if the client drops the stream.
+    with user_lock(user_id):
+        user_data = store.get_user(user_id)
+        if user_data is None:
+            user_data = copy.deepcopy(_USER_TEMPLATE)
+            store.set_user(user_id, user_data)
+
+    kwargs = {
+        'conflict': data.get('conflict', ''),
+        'setting': data.get('setting', ''),
+        'narrative_style': data.get('narrative_style', ''),
+        'mood': data.get('mood', ''),
+        'character_info': data.get('character_info', {}),
+        'custom_conflict': data.get('custom_conflict'),
+        'custom_setting': data.get('custom_setting'),
+        'custom_narrative': data.get('custom_narrative'),
+        'custom_mood': data.get('custom_mood'),
+        'protagonist_name': data.get('protagonist_name'),
+        'protagonist_gender': data.get('protagonist_gender'),
+        'protagonist_level': user_data['level'],
+    }
+
+    def event_stream():
+        # Drive the async generator step by step from this worker
+        loop = asyncio.new_event_loop()
+        agen = stream_story(**kwargs)
+        try:
+            while True:
+                try:
+                    event, payload = loop.run_until_complete(agen.__anext__())
+                except StopAsyncIteration:
+                    break
+
+                if event == 'delta':
+                    yield 'data: %s\n\n' % orjson.dumps({'delta': payload}).decode()
+                    continue
+
+                # Final event: persist exactly like the JSON endpoint
+                story_result = payload
+                story_id, story_data = _persist_story(story_result, user_id)
+
+                with user_lock(user_id):
+                    user_data = store.get_user(user_id)
+                    _add_story_mission(user_data, story_data, story_id)
+                    user_data['current_story_id'] = story_id
+                    store.set_user(user_id, user_data)
+
+                prefetch_choice_continuations(story_result, story_data)
+
+                yield 'data: %s\n\n' % orjson.dumps({
+                    'story_id': story_id,
+                    'generated_story': story_data,
+                    'user_progress': progress_view(user_data)
+                }).decode()
+        except Exception as e:
+            logger.error("Error streaming story: %s", str(e))
+            yield 'data: %s\n\n' % orjson.dumps({'error': str(e)}).decode()
+        finally:
+            loop.run_until_complete(agen.aclose())
+            loop.close()
+
+    return app.response_class(event_stream(), mimetype='text/event-stream')
+
 @app.route('/api/story/choice', methods=['POST'])
 def make_choice():
     """Record user's choice and return the next story node"""
-    data = request.json
+    data = request.get_json()
     user_id = data.get('user_id', 'default_user')
+
     story_id = data.get('story_id')
     choice_text = data.get('choice_text')
     choice_type = data.get('choice_type')
     currency_requirements = data.get('currency_requirements', {})
-    
-    # Check if user exists
-    if user_id not in users:
-        return jsonify({'error': 'User not found'}), 404
-    
-    # Check if story exists
-    if story_id not in stories:
-        return jsonify({'error': 'Story not found'}), 404
-    
-    # Check if user can afford the choice
-    user_data = users[user_id]
-    for currency, amount in currency_requirements.items():
-        if user_data['currency_balances'].get(currency, 0) < amount:
-            return jsonify({'error': f'Not enough {currency}'}), 400
-    
-    # Spend currency
-    for currency, amount in currency_requirements.items():
-        user_data['currency_balances'][currency] = user_data['currency_balances'].get(currency, 0) - amount
-    
-    # Record choice
-    user_data['choice_history'].append({
-        'choice_text': choice_text,
-        'story_id': story_id,
-        'timestamp': None  # Would be a timestamp in a real DB
-    })
-    
+
+    # Spend and record under the user lock so a double-submitted choice
+    # can't double-spend; the generation itself runs unlocked below
+    with user_lock(user_id):
+        # Fetch the user and the story in one pipelined round-trip
+        user_data, story = store.get_user_and_story(user_id, story_id)
+        if user_data is None:
+            return jsonify({'error': 'User not found'}), 404
+        if story is None:
+            return jsonify({'error': 'Story not found'}), 404
+
+        # Validate and compute the new balances in one pass — each
+        # currency is probed once, and nothing is deducted until every
+        # requirement clears
+        balances = user_data['currency_balances']
+        deductions = []
+        for currency, amount in currency_requirements.items():
+            remaining = balances.get(currency, 0) - amount
+            if remaining < 0:
+                return jsonify({'error': f'Not enough {currency}'}), 400
+            deductions.append((currency, remaining))
+
+        # Spend currency
+        for currency, remaining in deductions:
+            balances[currency] = remaining
+
+        # Record choice
+        user_data['choice_history'].append({
+            'choice_text': choice_text,
+            'story_id': story_id,
+            'timestamp': None  # Would be a timestamp in a real DB
+        })
+        store.set_user(user_id, user_data)
+
+
     # Generate next story segment
     try:
         # Get previous story data
-        previous_story = stories[story_id]['generated_story']
-        
+        previous_story = story['generated_story']
+
         # Generate next story segment based on previous context and choice
-        next_story_result = generate_story(
-            conflict=stories[story_id]['conflict'],
-            setting=stories[story_id]['setting'],
-            narrative_style=stories[story_id]['narrative_style'],
-            mood=stories[story_id]['mood'],
+        next_story_result = cached_generate_story(
+            conflict=story['conflict'],
+            setting=story['setting'],
+            narrative_style=story['narrative_style'],
+            mood=story['mood'],
             previous_choice=choice_text,
             story_context=previous_story.get('story', '')
         )
         
-        # Create new story ID and save
-        new_story_id = len(stories) + 1
-        next_story_data = json.loads(next_story_result['story'])
-        stories[new_story_id] = {
-            'id': new_story_id,
-            'user_id': user_id,
-            'conflict': next_story_result['conflict'],
-            'setting': next_story_result['setting'],
-            'narrative_style': next_story_result['narrative_style'],
-            'mood': next_story_result['mood'],
-            'generated_story': next_story_data,
-            'created_at': None,  # Would be a timestamp in a real DB
-            'parent_story_id': story_id  # Store reference to parent story
-        }
-        
-        # Update user's current story
-        users[user_id]['current_story_id'] = new_story_id
-        
+        # Create new story ID and save, keeping a reference to the parent
+        new_story_id, next_story_data = _persist_story(
+            next_story_result, user_id, parent_story_id=story_id)
+
+        # Update user's current story, re-fetched under the lock
+        with user_lock(user_id):
+            user_data = store.get_user(user_id)
+            user_data['current_story_id'] = new_story_id
+            store.set_user(user_id, user_data)
+
+        # Speculatively pre-generate the continuations the player can reach
+        prefetch_choice_continuations(next_story_result, next_story_data)
+
         # Return the next story segment
         return jsonify({
             'story_id': new_story_id,
             'generated_story': next_story_data,
-            'user_progress': users[user_id]
+            'user_progress': progress_view(user_data)
         })
         
     except Exception as e:
@@ -219,32 +430,31 @@ def make_choice():
 @app.route('/api/missions/complete', methods=['POST'])
 def complete_mission_route():
     """Mark a mission as completed and award the reward"""
-    data = request.json
+    data = request.get_json()
     user_id = data.get('user_id', 'default_user')
+
+    # Serialize per user so a double-submitted completion can't double-pay
+    with user_lock(user_id):
+        return _complete_mission_locked(data, user_id)
+
+def _complete_mission_locked(data, user_id):
     mission_id = data.get('mission_id')
-    
+
     # Check if user exists
-    if user_id not in users:
+    user_data = store.get_user(user_id)
+    if user_data is None:
         return jsonify({'error': 'User not found'}), 404
-    
-    # Find mission in active missions
-    user_data = users[user_id]
-    mission = None
-    for m in user_data['active_missions']:
-        if m['id'] == mission_id:
-            mission = m
-            break
-    
+
+    # O(1) removal from the active-mission index
+    mission = user_data['active_missions'].pop(str(mission_id), None)
+
     if not mission:
         return jsonify({'error': 'Mission not found'}), 404
-    
-    # Mark mission as completed
+
+    # Mark mission as completed and move it over
     mission['status'] = 'completed'
     mission['progress'] = 100
-    
-    # Move to completed missions
-    user_data['active_missions'].remove(mission)
-    user_data['completed_missions'].append(mission)
+    user_data['completed_missions'][str(mission_id)] = mission
     
     # Award reward
     currency = mission.get('reward_currency', '💵')
@@ -255,42 +465,54 @@ def complete_mission_route():
     xp_reward = 100  # Base XP reward
     user_data['experience_points'] += xp_reward
     
-    # Check for level up
-    import math
-    new_level = 1 + int(math.sqrt(user_data['experience_points'] / 100))
+    # Check for level up — integer sqrt avoids the float rounding hazard
+    new_level = 1 + isqrt(user_data['experience_points'] // 100)
     level_up = new_level > user_data['level']
     if level_up:
         user_data['level'] = new_level
-    
+
+    store.set_user(user_id, user_data)
+
     return jsonify({
         'success': True,
-        'user_progress': user_data,
+        'user_progress': progress_view(user_data),
         'level_up': level_up
     })
 
-@app.route('/api/progress/:user_id', methods=['GET'])
+@app.route('/api/progress/<uid:user_id>', methods=['GET'])
 def get_user_progress(user_id):
     """Get user progress data"""
-    if user_id not in users:
+    user_data = store.get_user(user_id)
+    if user_data is None:
         return jsonify({'error': 'User not found'}), 404
-    
-    return jsonify(users[user_id])
 
-@app.route('/api/story/current/:user_id', methods=['GET'])
+    return jsonify(progress_view(user_data))
+
+@app.route('/api/story/current/<uid:user_id>', methods=['GET'])
 def get_current_story(user_id):
     """Get user's current story"""
-    if user_id not in users:
+    user_data = store.get_user(user_id)
+    if user_data is None:
         return jsonify({'error': 'User not found'}), 404
-    
-    current_story_id = users[user_id]['current_story_id']
-    if not current_story_id or current_story_id not in stories:
+
+    current_story_id = user_data['current_story_id']
+    story = store.get_story(current_story_id) if current_story_id else None
+    if story is None:
         return jsonify({'error': 'No current story'}), 404
-    
+
     return jsonify({
         'story_id': current_story_id,
-        'generated_story': stories[current_story_id]['generated_story'],
-        'user_progress': users[user_id]
+        'generated_story': story['generated_story'],
+        'user_progress': progress_view(user_data)
     })
 
+@app.route('/api/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """Return LLM cache hit/miss counters"""
+    return jsonify(story_cache.stats)
+
+# Run under gunicorn in anything but local development — see wsgi.py.
+# The dev server below is single-threaded: one in-flight OpenAI call
+# blocks every other request.
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=3001, debug=True)
+    app.run(host='0.0.0.0', port=3001)
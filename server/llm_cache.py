@@ -0,0 +1,171 @@
+
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional
+
+import orjson
+from prometheus_client import Counter, Histogram
+
+from attached_assets.story_maker import generate_stories_batch, generate_story
+
+logger = logging.getLogger(__name__)
+
+# Metrics for tuning the cache TTL and watching OpenAI tail latency.
+# Lookup outcomes: hit (served from cache), inflight (joined a running
+# identical generation), miss (fresh OpenAI call).
+CACHE_LOOKUPS = Counter('llm_cache_lookups_total',
+                        'Story cache lookups by outcome', ['outcome'])
+OPENAI_LATENCY = Histogram('openai_generate_seconds',
+                           'Wall time of blocking generate_story calls',
+                           buckets=(0.1, 0.5, 1, 2, 5, 10, 30))
+
+# Defaults tuned for dev/test iteration, where replayed parameter combos
+# dominate; entries are whole generate_story payloads (a few KB each)
+_DEFAULT_TTL_SECONDS = 3600
+_DEFAULT_MAX_ENTRIES = 512
+
+
+class LLMCache:
+    """In-memory TTL + LRU cache for LLM responses
+
+    The interface is just get/put/stats, so a Redis client could replace
+    the dict backend without touching callers. Semantic near-miss matching
+    for free-text fields already lives in story_maker's embedding cache;
+    this layer stays cheap — one hash and a dict probe per request.
+    """
+
+    def __init__(self, ttl_seconds: int = _DEFAULT_TTL_SECONDS,
+                 max_entries: int = _DEFAULT_MAX_ENTRIES):
+        self._ttl = ttl_seconds
+        self._max_entries = max_entries
+        # key -> (expires_at, payload); insertion order doubles as the LRU
+        self._entries: Dict[str, tuple] = {}
+        # The prefetch worker writes from a background thread (a real OS
+        # thread when gevent is absent), so every multi-step dict
+        # operation runs under this lock
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+
+            expires_at, payload = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.stats["misses"] += 1
+                return None
+
+            # Re-insert so the entry moves to the most-recently-used end
+            del self._entries[key]
+            self._entries[key] = entry
+            self.stats["hits"] += 1
+            return payload
+
+    def contains(self, key: str) -> bool:
+        """Membership probe that doesn't touch the hit/miss counters"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[0] >= time.monotonic()
+
+    def put(self, key: str, payload: Any) -> None:
+        with self._lock:
+            if key in self._entries:
+                del self._entries[key]
+            elif len(self._entries) >= self._max_entries:
+                # Oldest entry sits at the front of the dict
+                self._entries.pop(next(iter(self._entries)))
+            self._entries[key] = (time.monotonic() + self._ttl, payload)
+
+
+# Shared cache for story generations
+story_cache = LLMCache()
+
+# Single-flight bookkeeping: key -> Future of the generation already
+# running for it. Futures block on threading primitives, which gevent
+# patches, so waiters yield the worker instead of pinning it.
+_inflight: Dict[str, Future] = {}
+_inflight_lock = threading.Lock()
+
+
+def _cache_key(kwargs: Dict[str, Any]) -> str:
+    """Stable hash of the full keyword set, including context/choice"""
+    return hashlib.sha256(orjson.dumps(kwargs, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+
+def cached_generate_story(**kwargs) -> Dict[str, Any]:
+    """generate_story with an exact-match response cache in front
+
+    A hit skips the multi-second OpenAI round-trip and its token cost
+    entirely. Continuations are cached too — previous_choice and
+    story_context are part of the key, so replayed story paths hit.
+    """
+    key = _cache_key(kwargs)
+    cached = story_cache.get(key)
+    if cached is not None:
+        logger.debug("LLM cache hit for key %.12s", key)
+        CACHE_LOOKUPS.labels('hit').inc()
+        return cached
+
+    # Single-flight: if an identical generation is already in flight,
+    # wait on its result instead of firing a duplicate OpenAI call
+    with _inflight_lock:
+        future = _inflight.get(key)
+        if future is not None:
+            leader = False
+        else:
+            future = Future()
+            _inflight[key] = future
+            leader = True
+
+    if not leader:
+        logger.debug("Joining in-flight generation for key %.12s", key)
+        CACHE_LOOKUPS.labels('inflight').inc()
+        return future.result()
+
+    CACHE_LOOKUPS.labels('miss').inc()
+    try:
+        with OPENAI_LATENCY.time():
+            payload = generate_story(**kwargs)
+        story_cache.put(key, payload)
+        future.set_result(payload)
+        return payload
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+
+
+def _prefetch_worker(param_dicts: List[Dict[str, Any]]) -> None:
+    try:
+        results = asyncio.run(generate_stories_batch(param_dicts))
+        for kwargs, payload in zip(param_dicts, results):
+            story_cache.put(_cache_key(kwargs), payload)
+        logger.debug("Prefetched %d story continuations", len(results))
+    except Exception as e:
+        # Speculative work — a failure costs nothing but the warm cache
+        logger.warning("Story prefetch failed: %s", str(e))
+
+
+def prefetch_generate_story(param_dicts: List[Dict[str, Any]]) -> None:
+    """Speculatively generate likely upcoming requests in the background
+
+    Fires the batch concurrently off-thread and warms the cache, so when
+    the player actually picks one of the prefetched branches the route
+    answers from cache instead of waiting out a fresh generation.
+    """
+    param_dicts = [kwargs for kwargs in param_dicts
+                   if not story_cache.contains(_cache_key(kwargs))
+                   and _cache_key(kwargs) not in _inflight]
+    if not param_dicts:
+        return
+    threading.Thread(target=_prefetch_worker, args=(param_dicts,), daemon=True).start()
@@ -0,0 +1,142 @@
+
+import itertools
+import logging
+import os
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+import orjson
+
+logger = logging.getLogger(__name__)
+
+# Stripe count for the in-memory store's user locks. One global lock would
+# serialize every request; 64 stripes keep contention to same-stripe
+# collisions only.
+_LOCK_STRIPES = 64
+
+
+def user_lock(user_id):
+    """The lock guarding read-modify-writes of this user's state
+
+    Backend-specific: a process-local stripe lock for MemoryStore, a
+    Redis SET NX lock for RedisStore so the guard holds across gunicorn
+    workers too.
+    """
+    return store.user_lock(user_id)
+
+
+class MemoryStore:
+    """In-process fallback store for single-worker development
+
+    Same interface as RedisStore; data is lost on restart and not shared
+    across workers.
+    """
+
+    def __init__(self):
+        self._users: Dict[str, Dict[str, Any]] = {}
+        self._stories: Dict[Any, Dict[str, Any]] = {}
+        # threading.Lock is gevent-aware once monkey-patched, so the same
+        # code works under both threaded and gevent workers
+        self._user_locks = [threading.Lock() for _ in range(_LOCK_STRIPES)]
+        # next() on a C-level iterator is atomic between greenlet yields
+        self._story_ids = itertools.count(1)
+        self._mission_ids = itertools.count(1)
+
+    def user_lock(self, user_id) -> threading.Lock:
+        """The stripe lock guarding mutations of this user's state"""
+        return self._user_locks[hash(user_id) & (_LOCK_STRIPES - 1)]
+
+    def next_story_id(self) -> int:
+        return next(self._story_ids)
+
+    def next_mission_id(self) -> int:
+        return next(self._mission_ids)
+
+    def get_user(self, user_id) -> Optional[Dict[str, Any]]:
+        return self._users.get(user_id)
+
+    def set_user(self, user_id, data: Dict[str, Any]) -> None:
+        self._users[user_id] = data
+
+    def get_story(self, story_id) -> Optional[Dict[str, Any]]:
+        return self._stories.get(story_id)
+
+    def set_story(self, story_id, data: Dict[str, Any]) -> None:
+        self._stories[story_id] = data
+
+    def get_user_and_story(self, user_id, story_id) -> Tuple[Optional[Dict[str, Any]],
+                                                             Optional[Dict[str, Any]]]:
+        return self._users.get(user_id), self._stories.get(story_id)
+
+
+class RedisStore:
+    """Redis-backed store so multiple workers share state across restarts
+
+    Values are orjson blobs under user:{id} / story:{id} keys. Reads that
+    need both a user and a story go through one pipelined round-trip.
+    """
+
+    def __init__(self, url: str):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+
+    def user_lock(self, user_id):
+        """Cross-worker lock guarding mutations of this user's state
+
+        gunicorn runs multiple processes, so a process-local lock can't
+        serialize them; redis-py's Lock is SET NX with an expiry, so a
+        crashed holder can't wedge the user for good.
+        """
+        return self._redis.lock(f"lock:user:{user_id}", timeout=30,
+                                blocking_timeout=10)
+
+    # INCR is atomic across workers, and the sequences persist alongside
+    # the data they key — no collisions between processes or after restart
+
+    def next_story_id(self) -> int:
+        return self._redis.incr("story:seq")
+
+    def next_mission_id(self) -> int:
+        return self._redis.incr("mission:seq")
+
+    @staticmethod
+    def _load(raw: Optional[bytes]) -> Optional[Dict[str, Any]]:
+        return orjson.loads(raw) if raw is not None else None
+
+    def get_user(self, user_id) -> Optional[Dict[str, Any]]:
+        return self._load(self._redis.get(f"user:{user_id}"))
+
+    def set_user(self, user_id, data: Dict[str, Any]) -> None:
+        self._redis.set(f"user:{user_id}", orjson.dumps(data))
+
+    def get_story(self, story_id) -> Optional[Dict[str, Any]]:
+        return self._load(self._redis.get(f"story:{story_id}"))
+
+    def set_story(self, story_id, data: Dict[str, Any]) -> None:
+        self._redis.set(f"story:{story_id}", orjson.dumps(data))
+
+    def get_user_and_story(self, user_id, story_id) -> Tuple[Optional[Dict[str, Any]],
+                                                             Optional[Dict[str, Any]]]:
+        # One network round-trip instead of two
+        raw_user, raw_story = (self._redis.pipeline(transaction=False)
+                               .get(f"user:{user_id}")
+                               .get(f"story:{story_id}")
+                               .execute())
+        return self._load(raw_user), self._load(raw_story)
+
+
+def make_store():
+    """Pick the backend: Redis when REDIS_URL is set, else in-memory"""
+    url = os.environ.get('REDIS_URL')
+    if url:
+        try:
+            store = RedisStore(url)
+            logger.info("Using Redis store at %s", url)
+            return store
+        except ImportError:
+            logger.warning("REDIS_URL is set but the redis package is missing; "
+                           "falling back to the in-memory store")
+    return MemoryStore()
+
+
+store = make_store()
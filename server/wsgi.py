@@ -0,0 +1,17 @@
+
+"""Gunicorn entry point for the story API.
+
+The workload is I/O-bound (waiting on OpenAI), so gevent workers let a
+single process keep hundreds of story requests in flight:
+
+    gunicorn -k gevent -w $((2 * $(nproc) + 1)) --worker-connections 1000 wsgi:app
+
+Prometheus metrics (cache hit rates, OpenAI latency histograms) are
+served at /metrics alongside the API.
+"""
+from prometheus_client import make_wsgi_app
+from werkzeug.middleware.dispatcher import DispatcherMiddleware
+
+from app import app as flask_app
+
+app = DispatcherMiddleware(flask_app, {'/metrics': make_wsgi_app()})